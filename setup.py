@@ -51,4 +51,9 @@ setup(
         'virtualenv>=13.1,<14',
         'voluptuous>=0.8,<0.9',
     ],
+    extras_require={
+        'uvloop': [
+            'uvloop>=0.5,<0.6',
+        ],
+    },
 )
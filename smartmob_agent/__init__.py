@@ -2,30 +2,38 @@
 
 import argparse
 import asyncio
+import collections
+import concurrent.futures
 import contextlib
 import fluent.sender
+import functools
+import hashlib
 import json
 import os
 import os.path
-import pkg_resources
 import procfile
+import re
+import shutil
 import structlog
 import structlog.processors
 import sys
-import tarfile
+import time
 import timeit
-import uuid
+import traceback
+import weakref
 import zipfile
 
-from aiohttp import ClientSession, web
+from aiohttp import ClientSession, TCPConnector, web
 from datetime import datetime, timezone
 from strawboss import run_and_respawn
 from urllib.parse import urlsplit
 from voluptuous import Schema, Required, MultipleInvalid
 
-version = pkg_resources.resource_string('smartmob_agent', 'version.txt')
-version = version.decode('utf-8').strip()
-"""Package version (as a dotted string)."""
+__here__ = os.path.dirname(os.path.abspath(__file__))
+
+with open(os.path.join(__here__, 'version.txt'), 'r') as stream:
+    version = stream.read().strip()
+    """Package version (as a dotted string)."""
 
 cli = argparse.ArgumentParser(description="Run programs.")
 cli.add_argument('--version', action='version', version=version,
@@ -63,10 +71,9 @@ class TimeStamper(object):
     def __call__(self, _, __, event_dict):
         timestamp = event_dict.get('@timestamp')
         if timestamp is None:
-            timestamp = self._now()
-        if isinstance(timestamp, datetime):
-            timestamp = timestamp.isoformat()
-        event_dict['@timestamp'] = timestamp
+            event_dict['@timestamp'] = self._now().isoformat()
+        elif isinstance(timestamp, datetime):
+            event_dict['@timestamp'] = timestamp.isoformat()
         return event_dict
 
 
@@ -78,7 +85,7 @@ async def inject_request_id(app, handler):
 
     async def trace_request(request):
         request['x-request-id'] = \
-            request.headers.get('x-request-id') or str(uuid.uuid4())
+            request.headers.get('x-request-id') or os.urandom(16).hex()
         return await handler(request)
 
     return trace_request
@@ -93,48 +100,38 @@ async def echo_request_id(request, response):
 
 
 async def access_log_middleware(app, handler):
-    """Log each request in structured event log."""
+    """Log each request in structured event log.
+
+    The application must provide ``smartmob.event_log`` and
+    ``smartmob.clock``.
+    """
 
-    event_log = app.get('smartmob.event_log') or structlog.get_logger()
-    clock = app.get('smartmob.clock') or timeit.default_timer
+    event_log = app['smartmob.event_log']
+    clock = app['smartmob.clock']
 
     # Keep the request arrival time to ensure we get intuitive logging of
-    # events.
-    arrival_time = datetime.utcnow().replace(tzinfo=timezone.utc)
+    # events.  Format it right away so the time stamper can pass it as-is.
+    arrival_time = datetime.utcnow().replace(tzinfo=timezone.utc).isoformat()
 
     async def access_log(request):
         ref = clock()
+        outcome = 500  # aiohttp reports unhandled exceptions as 500.
         try:
             response = await handler(request)
-            event_log.info(
-                'http.access',
-                path=request.path,
-                outcome=response.status,
-                duration=(clock()-ref),
-                request=request.get('x-request-id', '?'),
-                **{'@timestamp': arrival_time}
-            )
+            outcome = response.status
             return response
         except web.HTTPException as error:
-            event_log.info(
-                'http.access',
-                path=request.path,
-                outcome=error.status,
-                duration=(clock()-ref),
-                request=request.get('x-request-id', '?'),
-                **{'@timestamp': arrival_time}
-            )
+            outcome = error.status
             raise
-        except Exception:
+        finally:
             event_log.info(
                 'http.access',
                 path=request.path,
-                outcome=500,
+                outcome=outcome,
                 duration=(clock()-ref),
                 request=request.get('x-request-id', '?'),
                 **{'@timestamp': arrival_time}
             )
-            raise
 
     return access_log
 
@@ -164,7 +161,9 @@ class FluentLoggerFactory:
         self._app = app
         self._host = host
         self._port = port
-        self._sender = fluent.sender.FluentSender(app, host=host, port=port)
+        self._sender = FluentBatchSender(
+            fluent.sender.FluentSender(app, host=host, port=port),
+        )
 
     @property
     def host(self):
@@ -182,52 +181,208 @@ class FluentLoggerFactory:
         return FluentLogger(self._sender)
 
 
+class BatchWriter:
+    """Buffers log records and writes them out in batches.
+
+    Pending records are written at once when ``batch_size`` records are
+    queued or ``flush_interval`` seconds after the first pending record,
+    whichever comes first.  When the event loop is not running (e.g. during
+    startup and shutdown), records are written right away since nothing
+    would trigger the delayed flush.
+
+    Subclasses implement ``drain()`` to write out pending records.
+    """
+
+    def __init__(self, batch_size=100, flush_interval=0.1):
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._pending = collections.deque()
+        self._timer = None
+        batch_writers.add(self)
+
+    def push(self, record):
+        self._pending.append(record)
+        if len(self._pending) >= self._batch_size:
+            self.flush()
+            return
+        loop = asyncio.get_event_loop()
+        if not loop.is_running():
+            self.flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self._flush_interval, self.flush)
+
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        # NOTE: swap the queue out first so that records are dropped rather
+        #       than retried forever if draining them fails.
+        pending, self._pending = self._pending, collections.deque()
+        self.drain(pending)
+
+
+# Live batch writers, see ``flush_logs()``.
+batch_writers = weakref.WeakSet()
+
+
+def flush_logs():
+    """Write out log records still waiting in any batch writer."""
+    for writer in list(batch_writers):
+        writer.flush()
+
+
+class FluentBatchSender(BatchWriter):
+    """Buffers events and sends them to FluentD in batches."""
+
+    def __init__(self, sender, batch_size=100, flush_interval=0.1):
+        super().__init__(batch_size, flush_interval)
+        self._sender = sender
+
+    def emit(self, label, data):
+        self.push((label, int(time.time()), data))
+
+    def drain(self, records):
+        # NOTE: fluent-logger doesn't have a batch API, so we pack messages
+        #       ourselves and send them in a single write.
+        packets = b''.join(
+            self._make_packet(label, timestamp, data)
+            for label, timestamp, data in records
+        )
+        self._sender._send(packets)
+
+    def _make_packet(self, label, timestamp, data):
+        # Same fallback as ``FluentSender.emit_with_time()`` for events that
+        # can't be serialized.
+        try:
+            return self._sender._make_packet(label, timestamp, data)
+        except Exception:
+            return self._sender._make_packet(label, timestamp, {
+                'level': 'CRITICAL',
+                'message': "Can't output to log",
+                'traceback': traceback.format_exc(),
+            })
+
+
+class StreamBatchWriter(BatchWriter):
+    """Buffers log lines and writes them to a text stream in batches."""
+
+    def __init__(self, stream, batch_size=100, flush_interval=0.1):
+        super().__init__(batch_size, flush_interval)
+        self._stream = stream
+
+    def drain(self, records):
+        self._stream.write(''.join(records))
+        self._stream.flush()
+
+
+class StreamLoggerFactory:
+    """Structlog logger factory that writes to a text stream.
+
+    Unlike ``structlog.PrintLoggerFactory``, this doesn't flush the stream
+    after every single event.
+    """
+
+    def __init__(self, stream, batch_size=100, flush_interval=0.1):
+        self._writer = StreamBatchWriter(stream, batch_size, flush_interval)
+
+    def __call__(self):
+        return StreamLogger(self._writer)
+
+
+class StreamLogger:
+    """Structlog logger that writes rendered events to a text stream."""
+
+    def __init__(self, writer):
+        self._writer = writer
+
+    def msg(self, message):
+        self._writer.push(message + '\n')
+
+    # Same levels as ``structlog.PrintLogger``.
+    log = debug = info = warn = warning = msg
+    failure = err = error = critical = exception = msg
+
+
 class FluentLogger:
     """Structlog logger that sends events to FluentD."""
 
     def __init__(self, sender):
         self._sender = sender
 
-    def info(self, event, **kwds):
+    def msg(self, event, **kwds):
         self._sender.emit(event, kwds)
 
+    # Same levels as ``StreamLogger``.
+    log = debug = info = warn = warning = msg
+    failure = err = error = critical = exception = msg
 
-def configure_logging(log_format, utc, endpoint):
+
+# Renderers are stateless, so every logging setup shares the same ones.
+kv_renderer = structlog.processors.KeyValueRenderer(
+    sort_keys=True,
+    key_order=['@timestamp', 'event'],
+)
+json_renderer = structlog.processors.JSONRenderer(
+    sort_keys=True,
+)
+
+
+def logging_settings(log_format, utc, endpoint):
+    """Build keyword arguments for ``structlog.configure()``."""
     processors = [
         TimeStamper(
             key='@timestamp',
             utc=utc,
         ),
     ]
-    if endpoint.startswith('file://'):
-        path = endpoint[7:]
+    parts = urlsplit(endpoint)
+    if parts.scheme == 'file':
+        # NOTE: "file://./path" is accepted as a path relative to the current
+        #       working directory.
+        netloc = '' if parts.netloc == 'localhost' else parts.netloc
+        path = netloc + parts.path
         if path == '/dev/stdout':
             stream = sys.stdout
         elif path == '/dev/stderr':
             stream = sys.stderr
         else:
-            stream = open(path, 'w')
-        logger_factory = structlog.PrintLoggerFactory(file=stream)
+            stream = open(path, 'w', buffering=64 * 1024)
+        logger_factory = StreamLoggerFactory(stream)
         if log_format == 'kv':
-            processors.append(structlog.processors.KeyValueRenderer(
-                sort_keys=True,
-                key_order=['@timestamp', 'event'],
-            ))
+            processors.append(kv_renderer)
         else:
-            processors.append(structlog.processors.JSONRenderer(
-                sort_keys=True,
-            ))
-    elif endpoint.startswith('fluent://'):
+            processors.append(json_renderer)
+    elif parts.scheme == 'fluent':
         utc = True
         logger_factory = FluentLoggerFactory.from_url(endpoint)
     else:
         raise ValueError('Invalid logging endpoint "%s".' % endpoint)
-    structlog.configure(
-        processors=processors,
-        logger_factory=logger_factory,
-    )
+    return {
+        'processors': processors,
+        'logger_factory': logger_factory,
+    }
 
 
+def configure_logging(log_format, utc, endpoint):
+    structlog.configure(**logging_settings(log_format, utc, endpoint))
+
+
+json_encoder = json.JSONEncoder(separators=(',', ':'))
+
+
+def dump_json(document):
+    """Encode a JSON document for use as an HTTP response body."""
+    return json_encoder.encode(document).encode('utf-8')
+
+
+# Body for responses that have nothing to report.
+empty_json_body = dump_json({})
+
+
+# NOTE: response documents are built by the handlers below and are not
+#       validated at runtime; these schemas document their structure.
 Index = Schema({
     Required('list'): str,  # GET to query listing.
     Required('create'): str,  # POST to create new process.
@@ -257,65 +412,151 @@ CreateRequest = Schema({
 })
 
 
-@asyncio.coroutine
-def index(request):
-    list_url = '%s://%s%s' % (
-        request.scheme,
-        request.host,
-        request.app.router['list-processes'].url(),
-    )
-    create_url = '%s://%s%s' % (
-        request.scheme,
-        request.host,
-        request.app.router['create-process'].url(),
-    )
-    r = Index({
-        'list': list_url,
-        'create': create_url,
-    })
+def url_roots(request):
+    """Compute the HTTP and WebSocket URL prefixes used to reach us."""
+    host = request.host
+    return request.scheme + '://' + host, 'ws://' + host
+
+
+def index_renderer(routes, maxsize=8):
+    """Build a function that renders the index for a given URL prefix.
+
+    The index only depends on the URL prefix, so encoded bodies are reused.
+    The prefix comes from the client's ``Host`` header, so the cache is
+    bounded to keep clients from making it grow indefinitely.
+
+    :param routes: Named routes, as resolved in ``start_responder()``.
+    :param maxsize: Number of encoded bodies to keep around.
+    :return: A function that maps an HTTP URL prefix to a response body.
+    """
+
+    @functools.lru_cache(maxsize=maxsize)
+    def render(http_root):
+        return dump_json({
+            'list': http_root + routes['list-processes'].url(),
+            'create': http_root + routes['create-process'].url(),
+        })
+
+    return render
+
+
+async def index(request):
+    http_root, _ = url_roots(request)
     return web.Response(
         content_type='application/json',
-        body=json.dumps(r).encode('utf-8'),
+        body=request.app['smartmob.index'](http_root),
     )
 
 
-def make_details(request, process):
-    slug = process['slug']
-    details_url = '%s://%s%s' % (
-        request.scheme,
-        request.host,
-        request.app.router['process-status'].url(parts={'slug': slug}),
-    )
-    attach_url = '%s://%s%s' % (
-        'ws',
-        request.host,
-        request.app.router['attach-console'].url(parts={'slug': slug}),
-    )
-    delete_url = '%s://%s%s' % (
-        request.scheme,
-        request.host,
-        request.app.router['delete-process'].url(parts={'slug': slug}),
-    )
+def make_paths(routes, slug):
+    """Compute the URL paths of a process' resources.
+
+    These never change for a given process, so they're computed once when
+    the process is created and only prefixed with the URL roots when
+    formatting responses.
+
+    :param routes: Named routes, as resolved in ``start_responder()``.
+    :param slug: Unique process identifier.
+    :return: A dict of paths, keyed by ``ProcessDetails`` field name.
+    """
+    parts = {'slug': slug}
+    return {
+        'attach': routes['attach-console'].url(parts=parts),
+        'details': routes['process-status'].url(parts=parts),
+        'delete': routes['delete-process'].url(parts=parts),
+    }
+
+
+def make_details(roots, process):
+    """Format process details.
+
+    :param roots: HTTP and WebSocket URL prefixes, see ``url_roots()``.
+    :param process: Process bookkeeping, as stored by ``create_process()``.
+    :return: A ``ProcessDetails`` document.
+    """
+    http_root, ws_root = roots
+    paths = process['paths']
     return {
         'app': process['app'],
         'slug': process['slug'],
-        'attach': attach_url,
-        'details': details_url,
-        'delete': delete_url,
+        'attach': ws_root + paths['attach'],
+        'details': http_root + paths['details'],
+        'delete': http_root + paths['delete'],
         'state': process['state'],
     }
 
 
-def unpack_archive(archive_format, archive_path, source_path):
-    """Extract a .zip/.tar.gz archive to a folder."""
-    if archive_format not in ('zip', 'tar'):
+def extract_zip_members(archive_path, source_path, names):
+    """Extract some members of a .zip archive to a folder."""
+    with zipfile.ZipFile(archive_path) as archive:
+        for name in names:
+            try:
+                archive.extract(name, source_path)
+            except FileExistsError:  # pragma: no cover
+                # Another thread created the same parent folder concurrently.
+                archive.extract(name, source_path)
+
+
+def extract_zip(archive_path, source_path, workers=4):
+    """Extract a .zip archive to a folder.
+
+    Members of .zip archives are compressed independently, so they are
+    extracted by several threads at once (zlib releases the GIL while
+    inflating data).
+    """
+    with zipfile.ZipFile(archive_path) as archive:
+        names = archive.namelist()
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        list(pool.map(
+            functools.partial(
+                extract_zip_members, archive_path, source_path,
+            ),
+            [names[i::workers] for i in range(workers)],
+        ))
+
+
+@functools.lru_cache(maxsize=None)
+def zstd_command():
+    """Pick the zstd decompressor (looked up once).
+
+    ``pzstd`` decompresses on several cores, so prefer it when installed.
+    """
+    if shutil.which('pzstd'):
+        return 'pzstd -d'
+    return 'zstd -d'
+
+
+# Archive format for each source archive content type we accept.
+archive_formats = {
+    'application/zip': 'zip',
+    'application/x-gtar': 'tar',
+    'application/zstd': 'tar.zst',
+}
+
+
+async def unpack_archive(archive_format, archive_path, source_path,
+                         loop=None):
+    """Extract a .zip/.tar.gz/.tar.zst archive to a folder.
+
+    Tarballs are handed to the system ``tar`` command, which detects the
+    compression scheme by itself and is much faster than ``tarfile``.
+    """
+    loop = loop or asyncio.get_event_loop()
+    if archive_format not in archive_formats.values():
         raise ValueError('Unknown archive format "%s".' % archive_format)
     if archive_format == 'zip':
-        with zipfile.ZipFile(archive_path) as archive:
-            archive.extractall(source_path)
+        await loop.run_in_executor(
+            None, extract_zip, archive_path, source_path,
+        )
     if archive_format == 'tar':
-        with tarfile.open(archive_path) as archive:
-            archive.extractall(source_path)
+        os.makedirs(source_path, exist_ok=True)
+        await run_command('tar', '-xf', archive_path, '-C', source_path)
+    if archive_format == 'tar.zst':
+        os.makedirs(source_path, exist_ok=True)
+        await run_command(
+            'tar', '--use-compress-program', zstd_command(),
+            '-xf', archive_path, '-C', source_path,
+        )
 
 
 @contextlib.contextmanager
@@ -326,61 +567,133 @@ def autoclose(x):
         x.close()
 
 
-# TODO: stream by chunk to handle large archives.
-@asyncio.coroutine
-def download(client, url, path, request_id, reject=None):
+# Storage folders, relative to the current working directory.
+archives_path = os.path.join('.', '.smartmob', 'archives')
+sources_path = os.path.join('.', '.smartmob', 'sources')
+envs_path = os.path.join('.', '.smartmob', 'envs')
+envs_cache_path = os.path.join('.', '.smartmob', 'envs-cache')
+pip_cache_path = os.path.join('.', '.smartmob', 'pip-cache')
+
+# Upper bound on the size of source archives, to bound disk usage.
+max_archive_size = 1024 * 1024 * 1024
+
+# Lines in requirements.txt that refer to other files (editable installs,
+# nested requirements, constraints and local paths).
+local_requirement = re.compile(
+    br'^\s*(-e|--editable|-r|--requirement|-c|--constraint|\.|/|file:)',
+    re.MULTILINE,
+)
+
+
+async def download(client, url, path, request_id, reject=None,
+                   chunk_size=1024 * 1024, max_size=None, read_timeout=30.0,
+                   digest=None):
     if reject is None:
         reject = lambda _1, _2: False  # noqa: E731
 
     head = {
         'X-Request-Id': request_id,
     }
-    response = yield from client.get(url, headers=head)
+    response = await client.get(url, headers=head)
     with autoclose(response):
         if response.status != 200:
             raise Exception('Download failed.')
         if reject(url, response):
             raise Exception('Download rejected.')
-        with open(path, 'wb') as archive:
-            content = yield from response.read()
-            archive.write(content)
+        length = int(response.headers.get('Content-Length', 0))
+        if max_size is not None and length > max_size:
+            raise Exception('Download too large.')
+        # Stream to disk to keep memory usage flat for large archives.  Chunks
+        # are already large, so skip the extra copy through a Python buffer.
+        # Writes happen in a worker thread so that the event loop keeps
+        # running (and receiving the next chunk) while the disk catches up.
+        loop = asyncio.get_event_loop()
+
+        # Hash the archive on the fly when asked to, since we're already
+        # touching every byte (hashlib releases the GIL on large buffers).
+        def sink(chunk):
+            if digest is not None:
+                digest.update(chunk)
+            # Unbuffered writes may be short, keep going until it's all out.
+            view = memoryview(chunk)
+            while view:
+                view = view[archive.write(view):]
+
+        # Don't let a stalled server hold on to a download slot forever.
+        def read():
+            return asyncio.wait_for(
+                response.content.read(chunk_size), read_timeout,
+            )
+
+        size = 0
+        with open(path, 'wb', buffering=0) as archive:
+            chunk = await read()
+            while chunk:
+                size += len(chunk)
+                if max_size is not None and size > max_size:
+                    # Server didn't announce the size (or lied about it).
+                    raise Exception('Download too large.')
+                write = loop.run_in_executor(None, sink, chunk)
+                try:
+                    chunk = await read()
+                finally:
+                    await write
 
     return response.headers['Content-Type']
 
 
-@asyncio.coroutine
-def create_venv(path):
-    command = [
-        sys.executable, '-m', 'virtualenv', path,
-    ]
-    child = yield from asyncio.create_subprocess_exec(
+async def run_command(*command, env=None):
+    """Run a program to completion, discarding its output."""
+    child = await asyncio.create_subprocess_exec(
         *command,
-        stdin=asyncio.subprocess.PIPE,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.STDOUT,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.DEVNULL,
+        env=env,
     )
-    output, _ = yield from child.communicate()
-    status = yield from child.wait()
+    status = await child.wait()
     if status != 0:
         raise Exception('command failed')
 
 
-@asyncio.coroutine
-def pip_install(venv_path, deps_path):
-    command = [
+async def create_venv(path):
+    await run_command(sys.executable, '-m', 'virtualenv', path)
+
+
+async def pip_install(venv_path, deps_path, download_cache):
+    """Install requirements in a virtual environment.
+
+    pip keeps downloaded and built packages in ``download_cache`` so that
+    environments with overlapping requirements don't fetch and build the
+    same packages over and over again.
+    """
+    env = dict(os.environ)
+    env['PIP_CACHE_DIR'] = os.path.abspath(download_cache)
+    await run_command(
         os.path.join(venv_path, 'bin', 'pip'),
-        'install', '-r', deps_path,
-    ]
-    child = yield from asyncio.create_subprocess_exec(
-        *command,
-        stdin=asyncio.subprocess.PIPE,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.STDOUT,
+        'install', '--disable-pip-version-check', '-r', deps_path,
+        env=env,
     )
-    output, _ = yield from child.communicate()
-    status = yield from child.wait()
-    if status != 0:
-        raise Exception('command failed')
+
+
+def load_procfile(cache, digest, path, maxsize=64):
+    """Parse a Procfile, reusing the result for identical source archives.
+
+    :param cache: ``OrderedDict`` of parsed Procfiles, by archive digest.
+    :param digest: Hex digest of the source archive.
+    :param path: Path to the Procfile, as extracted from the archive.
+    :param maxsize: Number of parsed Procfiles to keep around.
+    :return: The process types, as returned by ``procfile.loadfile()``.
+    """
+    try:
+        process_types = cache[digest]
+    except KeyError:
+        process_types = cache[digest] = procfile.loadfile(path)
+        if len(cache) > maxsize:
+            cache.popitem(last=False)
+    else:
+        cache.move_to_end(digest)
+    return process_types
 
 
 def negate(f):
@@ -389,54 +702,49 @@ def negate(f):
     return _
 
 
-@asyncio.coroutine
-def start_process(app, process, request_id, loop=None):
+async def start_process(app, process, request_id, loop=None):
 
     loop = loop or asyncio.get_event_loop()
 
     # Download source archive.
     def is_archive(url, response):
-        return response.headers['Content-Type'] in (
-            'application/zip',
-            'application/x-gtar',
-        )
+        return response.headers['Content-Type'] in archive_formats
 
     client = app['smartmob.http-client']
-    archive_path = os.path.join(
-        '.', '.smartmob', 'archives',
-        process['slug'],
-    )
+    archive_path = os.path.join(archives_path, process['slug'])
+    archive_digest = hashlib.sha256()
     process['state'] = 'downloading'
-    try:
-        content_type = yield from download(
-            client, process['source_url'],
-            archive_path,
-            request_id=request_id,
-            reject=negate(is_archive),
-        )
-    except:
-        process['state'] = 'download failure'
-        raise
+    async with app['smartmob.download-slots']:
+        try:
+            content_type = await download(
+                client, process['source_url'],
+                archive_path,
+                request_id=request_id,
+                reject=negate(is_archive),
+                max_size=max_archive_size,
+                digest=archive_digest,
+            )
+        except:
+            process['state'] = 'download failure'
+            raise
     process['state'] = 'unpacking'
 
     # Deduce archive format.
-    archive_format = {
-        'application/zip': 'zip',
-        'application/x-gtar': 'tar',
-    }[content_type]
+    archive_format = archive_formats[content_type]
 
     # Unpack source archive.
-    source_path = os.path.join(
-        '.', '.smartmob', 'sources', process['slug'],
-    )
-    yield from loop.run_in_executor(
-        None, unpack_archive, archive_format, archive_path, source_path,
-    )
+    source_path = os.path.join(sources_path, process['slug'])
+    async with app['smartmob.setup-slots']:
+        await unpack_archive(
+            archive_format, archive_path, source_path, loop=loop,
+        )
     process['state'] = 'processing'
 
     # Load Procfile and lookup process type.
     try:
-        process_types = procfile.loadfile(
+        process_types = load_procfile(
+            app['smartmob.procfile-cache'],
+            archive_digest.hexdigest(),
             os.path.join(source_path, 'Procfile'),
         )
     except FileNotFoundError:
@@ -448,29 +756,57 @@ def start_process(app, process, request_id, loop=None):
         process['state'] = 'unknown process type'
         return
 
-    # Create virtual environment.
-    venv_path = os.path.join(
-        '.', '.smartmob', 'envs', process['slug'],
-    )
-    try:
-        yield from create_venv(venv_path)
-    except:
-        process['state'] = 'virtual environment failure'
-        raise
-
-    # Install dependencies.
+    # Create virtual environment and install dependencies.  Environments are
+    # shared by all processes that have the same requirements.
     deps_path = os.path.join(source_path, 'requirements.txt')
     try:
-        yield from pip_install(venv_path, deps_path)
-    except:
-        process['state'] = 'pip install failure'
-        raise
+        with open(deps_path, 'rb') as stream:
+            requirements = stream.read()
+    except FileNotFoundError:
+        # Nothing to install, share a bare environment.
+        deps_path = None
+        requirements = b''
+    deps_digest = hashlib.sha256(requirements)
+    # Requirements that point into the source tree resolve differently for
+    # each archive, so only share those environments for the same archive.
+    if local_requirement.search(requirements):
+        deps_digest.update(archive_digest.digest())
+    deps_hash = deps_digest.hexdigest()
+    cache_path = os.path.join(envs_cache_path, deps_hash)
+    ready_path = os.path.join(cache_path, '.smartmob-ready')
+    locks = app['smartmob.envs-cache-locks']
+    async with locks[deps_hash]:
+        if not os.path.exists(ready_path):
+            async with app['smartmob.setup-slots']:
+                shutil.rmtree(cache_path, ignore_errors=True)
+                try:
+                    await create_venv(cache_path)
+                except:
+                    process['state'] = 'virtual environment failure'
+                    shutil.rmtree(cache_path, ignore_errors=True)
+                    raise
+                try:
+                    if deps_path is not None:
+                        await pip_install(
+                            cache_path, deps_path,
+                            download_cache=pip_cache_path,
+                        )
+                except:
+                    process['state'] = 'pip install failure'
+                    shutil.rmtree(cache_path, ignore_errors=True)
+                    raise
+                with open(ready_path, 'wb'):
+                    pass
+    venv_path = os.path.join(envs_path, process['slug'])
+    if os.path.lexists(venv_path):
+        os.unlink(venv_path)
+    os.symlink(os.path.abspath(cache_path), venv_path)
 
     # Run it again and again until somebody requests to kill this process.
     #
     # TODO: figure out how to get status updates so REST API reflects actual
     #       status.
-    yield from run_and_respawn(
+    await run_and_respawn(
         name=process['slug'],
         cmd=process_type['cmd'],
         env=dict(process_type['env']),
@@ -478,20 +814,19 @@ def start_process(app, process, request_id, loop=None):
     )
 
 
-@asyncio.coroutine
-def create_process(request):
+async def create_process(request):
     loop = asyncio.get_event_loop()
-    event_log = request.app.get('smartmob.event_log') or structlog.get_logger()
+    event_log = request.app['smartmob.event_log']
 
     # Validate request.
-    r = yield from request.json()
+    r = await request.json()
     try:
         r = CreateRequest(r)
     except MultipleInvalid:
         raise web.HTTPBadRequest
 
     # Initiate process creation.
-    processes = request.app.setdefault('smartmob.processes', {})
+    processes = request.app['smartmob.processes']
     slug = '.'.join((r['app'], r['node']))
     if slug in processes:
         raise web.HTTPConflict
@@ -501,6 +836,7 @@ def create_process(request):
 
     # Proceed.
     r['slug'] = slug
+    r['paths'] = make_paths(request.app['smartmob.routes'], slug)
     r['stop'] = asyncio.Future()
     r['task'] = loop.create_task(start_process(
         request.app, r, loop=loop,
@@ -510,23 +846,20 @@ def create_process(request):
     processes[slug] = r
 
     # Format response.
-    process = make_details(request, r)
+    process = make_details(url_roots(request), r)
     return web.HTTPCreated(
         content_type='application/json',
-        body=json.dumps(ProcessDetails(
-            process,
-        )).encode('utf-8'),
+        body=dump_json(process),
         headers={
             'Location': process['details'],
         },
     )
 
 
-@asyncio.coroutine
-def process_status(request):
+async def process_status(request):
 
     # Lookup process.
-    processes = request.app.setdefault('smartmob.processes', {})
+    processes = request.app['smartmob.processes']
     slug = request.match_info['slug']
     try:
         process = processes[slug]
@@ -536,19 +869,16 @@ def process_status(request):
     # Format response.
     return web.Response(
         content_type='application/json',
-        body=json.dumps(ProcessDetails(
-            make_details(request, process)
-        )).encode('utf-8'),
+        body=dump_json(make_details(url_roots(request), process)),
     )
 
 
-@asyncio.coroutine
-def delete_process(request):
+async def delete_process(request):
 
-    event_log = request.app.get('smartmob.event_log') or structlog.get_logger()
+    event_log = request.app['smartmob.event_log']
 
     # Resolve the process.
-    processes = request.app.setdefault('smartmob.processes', {})
+    processes = request.app['smartmob.processes']
     slug = request.match_info['slug']
     try:
         process = processes[slug]
@@ -561,7 +891,7 @@ def delete_process(request):
     # Kill the process and wait for it to complete.
     process['stop'].set_result(None)
     try:
-        yield from process['task']
+        await process['task']
     except Exception:  # TODO: be more accurate!
         pass
 
@@ -571,30 +901,27 @@ def delete_process(request):
     # Format the response.
     return web.Response(
         content_type='application/json',
-        body=json.dumps({
-            # ...
-        }).encode('utf-8'),
+        body=empty_json_body,
     )
 
 
-@asyncio.coroutine
-def attach_console(request):
+async def attach_console(request):
 
-    event_log = request.app.get('smartmob.event_log') or structlog.get_logger()
+    event_log = request.app['smartmob.event_log']
 
     # Must connect here with a WebSocket.
     if request.headers.get('Upgrade', '').lower() != 'websocket':
         pass
 
     # Resolve the process.
-    processes = request.app.setdefault('smartmob.processes', {})
+    processes = request.app['smartmob.processes']
     slug = request.match_info['slug']
     if slug not in processes:
         raise web.HTTPNotFound
 
     # WebSocket handshake.
     stream = web.WebSocketResponse()
-    yield from stream.prepare(request)
+    await stream.prepare(request)
 
     # TODO: retrieve data from the process and pipe it to the WebSocket.
     #       Strawboss implementation doesn't provide anything for this at the
@@ -604,27 +931,28 @@ def attach_console(request):
     event_log.info('process.attach', slug=slug)
 
     # Close the WebSocket.
-    yield from stream.close()
+    await stream.close()
 
     # Required by the framework, but I don't know why.
     return stream
 
 
-@asyncio.coroutine
-def list_processes(request):
-    processes = request.app.setdefault('smartmob.processes', {})
+async def list_processes(request):
+    processes = request.app['smartmob.processes']
+    roots = url_roots(request)
     return web.Response(
         content_type='application/json',
-        body=json.dumps(Listing({
+        body=dump_json({
             'processes': [
-                make_details(request, p) for p in processes.values()
+                make_details(roots, p)
+                for p in processes.values()
             ],
-        })).encode('utf-8'),
+        }),
     )
 
 
-@asyncio.coroutine
-def start_responder(host='127.0.0.1', port=8080, event_log=None, loop=None):
+async def start_responder(host='127.0.0.1', port=8080, event_log=None,
+                          loop=None):
     """."""
 
     loop = loop or asyncio.get_event_loop()
@@ -636,6 +964,9 @@ def start_responder(host='127.0.0.1', port=8080, event_log=None, loop=None):
         access_log_middleware,
     ])
     app.on_response_prepare.append(echo_request_id)
+    app['smartmob.event_log'] = event_log
+    app['smartmob.clock'] = timeit.default_timer
+    app['smartmob.processes'] = {}
     app.router.add_route('GET', '/', index)
     app.router.add_route('POST', '/create-process',
                          create_process, name='create-process')
@@ -648,28 +979,36 @@ def start_responder(host='127.0.0.1', port=8080, event_log=None, loop=None):
     app.router.add_route('GET', '/list-processes',
                          list_processes, name='list-processes')
 
-    # Create storage folders.
-    archives_path = os.path.join(
-        '.', '.smartmob', 'archives',
-    )
-    if not os.path.isdir(archives_path):
-        os.makedirs(archives_path)
-    sources_path = os.path.join(
-        '.', '.smartmob', 'sources',
-    )
-    if not os.path.isdir(sources_path):
-        os.makedirs(sources_path)
-    envs_path = os.path.join(
-        '.', '.smartmob', 'envs',
-    )
-    if not os.path.isdir(envs_path):
-        os.makedirs(envs_path)
+    # Resolve named routes once instead of on each request.
+    app['smartmob.routes'] = {
+        name: app.router[name] for name in (
+            'create-process',
+            'process-status',
+            'delete-process',
+            'attach-console',
+            'list-processes',
+        )
+    }
+    app['smartmob.index'] = index_renderer(app['smartmob.routes'])
+    app['smartmob.envs-cache-locks'] = collections.defaultdict(asyncio.Lock)
+    app['smartmob.procfile-cache'] = collections.OrderedDict()
 
-    event_log.info('bind', transport='tcp', host=host, port=port)
+    # Bound the number of process starts that download archives at once and
+    # that unpack archives and build virtual environments at once, so that
+    # bursts of requests don't thrash the network, disks and CPUs.
+    app['smartmob.download-slots'] = asyncio.Semaphore(4)
+    app['smartmob.setup-slots'] = asyncio.Semaphore(os.cpu_count() or 1)
+
+    # Create storage folders.
+    for path in (archives_path, sources_path, envs_path, envs_cache_path):
+        os.makedirs(path, exist_ok=True)
 
-    # Start accepting connections.
+    # Start accepting connections.  Port 0 lets the OS pick a free port, so
+    # log the one we actually got.
     handler = app.make_handler()
-    server = yield from loop.create_server(handler, host, port)
+    server = await loop.create_server(handler, host, port)
+    port = server.sockets[0].getsockname()[1]
+    event_log.info('bind', transport='tcp', host=host, port=port)
     return app, handler, server
 
 
@@ -680,26 +1019,37 @@ def responder(event_loop, event_log=None, host='127.0.0.1', port=8080):
         start_responder(loop=event_loop, event_log=event_log,
                         host=host, port=port)
     )
-    client = ClientSession(loop=event_loop)
+    # Archives usually come from the same few hosts, so keep connections
+    # and DNS results around between downloads.
+    connector = TCPConnector(
+        loop=event_loop,
+        limit=32,
+        use_dns_cache=True,
+        keepalive_timeout=75,
+    )
+    client = ClientSession(loop=event_loop, connector=connector)
     with autoclose(client):
         app['smartmob.http-client'] = client
-        app['smartmob.event_log'] = event_log
-        app['smartmob.clock'] = timeit.default_timer
         try:
-            yield 'http://127.0.0.1:8080', app, handler, server
+            port = server.sockets[0].getsockname()[1]
+            yield 'http://127.0.0.1:%d' % port, app, handler, server
         finally:
             server.close()
             event_loop.run_until_complete(server.wait_closed())
             event_loop.run_until_complete(handler.finish_connections(1.0))
             event_loop.run_until_complete(app.finish())
+            # The event loop stopped, so pending flush timers won't fire.
+            flush_logs()
 
 
-def main(arguments=None):
+def main(arguments=None, stop=None):
     """Command-line entry point.
 
     :param arguments: List of strings that contain the command-line arguments.
        When ``None``, the command-line arguments are looked up in ``sys.argv``
        (``sys.argv[0]`` is ignored).
+    :param stop: ``asyncio.Event`` that shuts the agent down once set.  When
+       ``None``, the agent runs until interrupted with CTRL-C.
     :return: This function has no return value.
     :raise SystemExit: The command-line arguments are invalid.
     """
@@ -724,6 +1074,18 @@ def main(arguments=None):
     )
     event_log = structlog.get_logger()
 
+    # Prefer the libuv-based event loop, when available.
+    try:
+        import uvloop
+    except ImportError:
+        pass
+    else:  # pragma: no cover
+        # NOTE: replacing the policy drops the current event loop, so leave
+        #       it alone if it's already on uvloop (e.g. in tests).
+        policy = asyncio.get_event_loop_policy()
+        if not isinstance(policy, uvloop.EventLoopPolicy):
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
     # Start the event loop.
     loop = asyncio.get_event_loop()
 
@@ -732,9 +1094,14 @@ def main(arguments=None):
         with responder(loop, event_log=event_log,
                        host=arguments.host,
                        port=arguments.port):
-            loop.run_forever()  # pragma: no cover
+            if stop is None:
+                loop.run_forever()  # pragma: no cover
+            else:
+                loop.run_until_complete(stop.wait())
     except KeyboardInterrupt:
         event_log.info('stop', reason='ctrl-c')
+    else:
+        event_log.info('stop', reason='requested')
 
 
 if __name__ == '__main__':  # pragma: no cover
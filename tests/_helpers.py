@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+"""Helpers shared by the test modules."""
+
+import asyncio
+import smartmob_agent
+
+from contextlib import contextmanager
+from functools import partial
+from unittest import mock
+
+
+async def fetch_http(client, url):
+    """Fetch ``url`` and return the (stripped) response body."""
+    async with client.get(url) as response:
+        assert response.status == 200
+        body = await response.read()
+    return body.strip()
+
+
+async def wait_until(predicate, max_delay=0.2):
+    """Wait until ``predicate()`` is true.
+
+    Checks right away, then backs off exponentially up to ``max_delay``.
+    The predicate may also be a coroutine function.
+    """
+    delay = 0.0
+    while True:
+        done = predicate()
+        if asyncio.iscoroutine(done):
+            done = await done
+        if done:
+            return
+        await asyncio.sleep(delay)
+        delay = min(max(2 * delay, 0.005), max_delay)
+
+
+def forward(target, source):
+    """Copy the outcome of future ``source`` into future ``target``."""
+    try:
+        target.set_result(source.result())
+    except Exception as error:
+        target.set_exception(error)
+
+
+def hello_http(loop, client, future, url):
+    """Schedule a fetch of ``url`` and report its outcome to ``future``."""
+    task = loop.create_task(fetch_http(client, url))
+    task.add_done_callback(partial(forward, future))
+
+
+@contextmanager
+def when_serving(loop, callback, *args):
+    """Call ``callback(*args, url)`` as soon as the agent accepts connections.
+
+    ``url`` points to the agent on whichever port it was bound to.
+    """
+    start_responder = smartmob_agent.start_responder
+
+    async def start_and_notify(*a, **kw):
+        app, handler, server = await start_responder(*a, **kw)
+        port = server.sockets[0].getsockname()[1]
+        loop.call_soon(callback, *args, 'http://127.0.0.1:%d' % port)
+        return app, handler, server
+
+    with mock.patch('smartmob_agent.start_responder', start_and_notify):
+        yield
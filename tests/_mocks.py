@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+"""Mock objects shared by the test fixtures."""
+
+import asyncio
+import random
+
+
+class MockSubprocess(object):
+    """Mock implementation of asyncio ``Popen`` object."""
+
+    def __init__(self, args, kwds):
+        self.args = args
+        self._kwds = kwds
+        #
+        self.pid = random.randint(1, 9999)
+        self.stdout = asyncio.StreamReader()
+        #
+        self._future = asyncio.Future()
+        self._killed = False
+
+    @property
+    def env(self):
+        """Retrieve the environment variables passed to the process."""
+        return {k: v for k, v in self._kwds['env'].items()}
+
+    def wait(self):
+        """Wait until the process completes."""
+        return self._future
+
+    def mock_complete(self, exit_code=0):
+        if not self._future.done():
+            self._future.set_result(exit_code)
+
+    def kill(self):
+        if self._future.done():
+            raise ProcessLookupError
+        # Defer completion (as IRL).
+        loop = asyncio.get_event_loop()
+        loop.call_soon(self._future.set_result, -9)
+
+
+class MockSubprocessFactory(object):
+    def __init__(self):
+        self._instances = []
+
+    @property
+    def instances(self):
+        return self._instances[:]
+
+    @property
+    def last_instance(self):
+        return self._instances[-1]
+
+    def spawn(self, args, kwds):
+        p = MockSubprocess(args, kwds)
+        self._instances.append(p)
+        return p
+
+
+class EventCollector(object):
+    """Stand-in for a structlog logger that records ``info()`` events."""
+
+    def __init__(self):
+        self.events = []
+
+    def info(self, event, **kwds):
+        self.events.append((event, kwds))
@@ -4,48 +4,112 @@ import aiohttp
 import aiohttp.web
 import aiotk
 import asyncio
+import contextlib
 import functools
+import gzip
+import io
 import msgpack
 import os
 import os.path
 import pytest
 import shutil
+import socket
 import structlog
-import random
+import tarfile
 import tempfile
 import testfixtures
 import timeit
 import unittest.mock
 import urllib.parse
+import zipfile
 
+from _mocks import MockSubprocessFactory
 from smartmob_agent import (
     access_log_middleware,
     autoclose,
-    configure_logging,
     echo_request_id,
     inject_request_id,
+    logging_settings,
     responder,
 )
 from unittest import mock
 
+# Run the test suite on uvloop when it's available, like the agent does.
+# pytest-asyncio's ``event_loop`` fixture creates loops through the policy.
+try:
+    import uvloop
+except ImportError:
+    pass
+else:
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
 __here__ = os.path.dirname(os.path.abspath(__file__))
 
+# Logger methods that the mock event log accepts: the log levels that both
+# ``StreamLogger`` and ``FluentLogger`` implement, plus what structlog's
+# bound loggers add on top.
+event_log_methods = (
+    'debug', 'info', 'warning', 'error', 'critical', 'exception',
+    'bind', 'new',
+)
+
+
+@pytest.yield_fixture(scope='session')
+def event_loop():
+    """Share one event loop across the whole test session.
+
+    This lets servers and other expensive fixtures be session-scoped.
+    """
+    loop = asyncio.get_event_loop_policy().new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+
 
 @pytest.fixture(scope='function')
 def event_log():
-    return mock.MagicMock(autospec=structlog.get_logger())
+    return mock.MagicMock(spec_set=event_log_methods)
 
 
 @pytest.yield_fixture
-def server(event_loop, event_log):
+def server(event_loop, event_log, tempdir):
+    # NOTE: run in a temporary folder so that virtual environments cached by
+    #       one test don't leak into others.
     with responder(event_loop=event_loop,
                    event_log=event_log) as (endpoint, app, handler, server):
         yield endpoint
 
 
-@pytest.yield_fixture
+@pytest.fixture(scope='session')
+def index_cache():
+    return {}
+
+
+@pytest.fixture
+def index(event_loop, server, client, index_cache):
+    """Links from the agent's index, cached per server endpoint.
+
+    The index holds absolute URLs, so it's keyed on the server's URL.  This
+    only saves requests because ``server`` always binds the same port; if
+    it ever binds port 0, every test will fetch the index again.
+    """
+    if server not in index_cache:
+        async def fetch_index():
+            response = await client.get(server)
+            with autoclose(response):
+                assert response.status == 200
+                return await response.json()
+        index_cache[server] = event_loop.run_until_complete(fetch_index())
+    return index_cache[server]
+
+
+@pytest.yield_fixture(scope='session')
 def client(event_loop):
-    session = aiohttp.ClientSession(loop=event_loop)
+    """HTTP client shared by all tests, to reuse keep-alive connections."""
+    connector = aiohttp.TCPConnector(
+        loop=event_loop, limit=32, keepalive_timeout=60,
+    )
+    session = aiohttp.ClientSession(loop=event_loop, connector=connector)
     with autoclose(session):
         yield session
 
@@ -59,6 +123,10 @@ class FileServer(object):
     def endpoint(self):
         return self._endpoint
 
+    @property
+    def root(self):
+        return self._root
+
     def url(self, name):
         return urllib.parse.urljoin(self._endpoint, name)
 
@@ -66,64 +134,203 @@ class FileServer(object):
         if name:
             path = os.path.join(self._root, name)
         else:
-            path = tempfile.mktemp(dir=self._root)
+            fd, path = tempfile.mkstemp(dir=self._root)
+            os.close(fd)
         if data is None:
             return path
-        if not isinstance(data, str):
+        if not isinstance(data, (str, bytes)):
             data = data.read()
-        with open(path, 'w') as stream:
-            stream.write(data)
+        if isinstance(data, bytes):
+            with open(path, 'wb') as stream:
+                stream.write(data)
+        else:
+            with open(path, 'w', encoding='utf-8') as stream:
+                stream.write(data)
 
 
-@pytest.yield_fixture
-def file_server(event_loop, temp_folder, event_log):
+@pytest.yield_fixture(scope='session')
+def file_server_app(event_loop):
+    """Static file server shared by all tests, see ``file_server``."""
     host = '127.0.0.1'
-    port = 8081
+    root = tempfile.mkdtemp()
     app = aiohttp.web.Application(loop=event_loop, middlewares=[
         inject_request_id,
         access_log_middleware,
     ])
     app.on_response_prepare.append(echo_request_id)
+
+    # Serve files gzip-encoded on the fly under ``/gzip/``.
+    async def serve_gzip(request):
+        path = os.path.join(root, request.match_info['name'])
+        with open(path, 'rb') as stream:
+            body = gzip.compress(stream.read())
+        return aiohttp.web.Response(
+            body=body, content_type='text/plain',
+            headers={'Content-Encoding': 'gzip'},
+        )
+
+    app.router.add_route('GET', '/gzip/{name}', serve_gzip)
     app.router.add_static(
-        '/', temp_folder,
+        '/', root,
     )
-    app['smartmob.event_log'] = event_log
+    app['smartmob.event_log'] = mock.MagicMock()
     app['smartmob.clock'] = timeit.default_timer
     handler = app.make_handler()
+    # NOTE: let the OS pick a free port so parallel test runs don't clash.
     server = event_loop.run_until_complete(event_loop.create_server(
-        handler, host, port,
+        handler, host, 0,
     ))
-    yield FileServer('http://%s:%d/' % (host, port), temp_folder)
+    port = server.sockets[0].getsockname()[1]
+    yield app, FileServer('http://%s:%d/' % (host, port), root)
     server.close()
     event_loop.run_until_complete(server.wait_closed())
-    event_loop.run_until_complete(handler.finish_connections(1.0))
+    # NOTE: the only lingering connections are idle keep-alives from the
+    #       shared client, so there's nothing worth waiting for.
+    event_loop.run_until_complete(handler.finish_connections(0.0))
     event_loop.run_until_complete(app.finish())
+    shutil.rmtree(root)
+
+
+@pytest.yield_fixture
+def file_server(file_server_app, event_log):
+    """Static file server, starting empty and logging to ``event_log``."""
+    app, server = file_server_app
+    app['smartmob.event_log'] = event_log
+    yield server
+    clear_folder(server.root)
+
+
+def make_zip(members, compression=zipfile.ZIP_STORED):
+    """Build a .zip archive in memory."""
+    stream = io.BytesIO()
+    with zipfile.ZipFile(stream, 'w', compression) as archive:
+        for name, data in members:
+            archive.writestr(name, data)
+    return stream.getvalue()
+
+
+@pytest.fixture(scope='session')
+def canned_archives():
+    """Source archives used throughout the tests, built once."""
+    return {
+        'web': make_zip([
+            ('Procfile', 'web: python dots.py'),
+            ('requirements.txt', 'Flask==0.10.1'),
+        ]),
+        'no-procfile': make_zip([
+            ('requirements.txt', 'Flask==0.10.1'),
+        ]),
+        'no-requirements': make_zip([
+            ('Procfile', 'web: python dots.py'),
+        ]),
+        'editable-1': make_zip([
+            ('Procfile', 'web: python dots.py'),
+            ('requirements.txt', '-e .'),
+            ('setup.py', 'VERSION = 1'),
+        ]),
+        'editable-2': make_zip([
+            ('Procfile', 'web: python dots.py'),
+            ('requirements.txt', '-e .'),
+            ('setup.py', 'VERSION = 2'),
+        ]),
+    }
+
+
+def make_tar(members):
+    """Build a .tar archive in memory."""
+    stream = io.BytesIO()
+    with tarfile.open(fileobj=stream, mode='w') as archive:
+        for name, data in members:
+            member = tarfile.TarInfo(name)
+            member.size = len(data)
+            archive.addfile(member, io.BytesIO(data))
+    return stream.getvalue()
+
+
+sample_members = [
+    ('Procfile', b'python-help: python --help'),
+    ('requirements.txt', b'somelib==1.0'),
+]
+
+
+@pytest.yield_fixture(scope='session')
+def sample_folder():
+    """Folder holding the sample archives, see ``sample_zip``."""
+    path = tempfile.mkdtemp()
+    yield path
+    shutil.rmtree(path)
+
+
+def write_sample(folder, name, data):
+    path = os.path.join(folder, name)
+    with open(path, 'wb') as stream:
+        stream.write(data)
+    return path
+
+
+@pytest.fixture(scope='session', params=['stored', 'deflated'])
+def sample_zip(request, sample_folder):
+    """Path to a sample .zip archive, built once (don't modify it).
+
+    Parametrized over stored and deflated members.
+    """
+    compression = {
+        'stored': zipfile.ZIP_STORED,
+        'deflated': zipfile.ZIP_DEFLATED,
+    }[request.param]
+    return write_sample(
+        sample_folder, 'sample-%s.zip' % request.param,
+        make_zip(sample_members, compression),
+    )
+
+
+@pytest.fixture(scope='session')
+def sample_tar(sample_folder):
+    """Path to a sample .tar archive, built once (don't modify it)."""
+    return write_sample(sample_folder, 'sample.tar', make_tar(sample_members))
 
 
 @pytest.yield_fixture
 def mktemp():
-    """py.test fixture that generates a file name and erases it later."""
+    """py.test fixture that creates an empty file and erases it later."""
     files = []
 
     def _():
-        path = tempfile.mktemp()
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
         files.append(path)
         return path
     yield _
     # Delete all temporary files.
     for path in files:
-        if os.path.isdir(path):
+        if os.path.exists(path):
             os.unlink(path)
 
 
-@pytest.yield_fixture
-def temp_folder():
-    """py.test fixture that creates a temporary folder."""
+def clear_folder(path):
+    """Remove everything inside a folder, but keep the folder itself."""
+    for entry in os.scandir(path):
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path)
+        else:
+            os.unlink(entry.path)
+
+
+@pytest.yield_fixture(scope='session')
+def temp_folder_session():
+    """Temporary folder shared by all tests, see ``temp_folder``."""
     path = tempfile.mkdtemp()
     yield path
     shutil.rmtree(path)
 
 
+@pytest.yield_fixture
+def temp_folder(temp_folder_session):
+    """py.test fixture that provides an empty temporary folder."""
+    yield temp_folder_session
+    clear_folder(temp_folder_session)
+
+
 @pytest.yield_fixture(scope='function')
 def tempdir():
     old_cwd = os.getcwd()
@@ -134,127 +341,120 @@ def tempdir():
         directory.cleanup()
 
 
-class MockSubprocess(object):
-    """Mock implementation of asyncio ``Popen`` object."""
+@pytest.yield_fixture(scope='session')
+def subprocess_spawner():
+    """Patch ``asyncio.create_subprocess_exec`` once for the whole session.
 
-    def __init__(self, args, kwds):
-        self._kwds = kwds
-        #
-        self.pid = random.randint(1, 9999)
-        self.stdout = asyncio.StreamReader()
-        #
-        self._future = asyncio.Future()
-        self._killed = False
-
-    @property
-    def env(self):
-        """Retrieve the environment variables passed to the process."""
-        return {k: v for k, v in self._kwds['env'].items()}
-
-    # TODO: not sure what this should do!
-    @asyncio.coroutine
-    def communicate(self, input=None):
-        yield from self._future
-        return '', ''
-
-    def wait(self):
-        """Wait until the process completes."""
-        return self._future
-
-    def mock_complete(self, exit_code=0):
-        if not self._future.done():
-            self._future.set_result(exit_code)
-
-    def kill(self):
-        if self._future.done():
-            raise ProcessLookupError
-        # Defer completion (as IRL).
-        loop = asyncio.get_event_loop()
-        loop.call_soon(self._future.set_result, -9)
+    Processes are spawned for real, except while a ``subprocess_factory``
+    fixture is active.  Yields the stack of active factories.
+    """
 
+    factories = []
+    create_subprocess_exec_ = asyncio.create_subprocess_exec
 
-class MockSubprocessFactory(object):
-    def __init__(self):
-        self._instances = []
+    @functools.wraps(create_subprocess_exec_)
+    async def create_subprocess_exec(*args, **kwds):
+        if factories:
+            return factories[-1].spawn(args, kwds)
+        return await create_subprocess_exec_(*args, **kwds)
 
-    @property
-    def instances(self):
-        return self._instances[:]
-
-    @property
-    def last_instance(self):
-        return self._instances[-1]
+    with unittest.mock.patch('asyncio.create_subprocess_exec',
+                             create_subprocess_exec):
+        yield factories
 
 
 @pytest.yield_fixture
-def subprocess_factory():
+def subprocess_factory(subprocess_spawner):
     """Fixture to mock asyncio subprocess creation.
 
-    Each time ``asyncio.create_subprocess_exec`` is called, a future that
-    resolves to a ``MockSubprocess`` object will be returned.
+    Each time ``asyncio.create_subprocess_exec`` is called, a coroutine that
+    returns a ``MockSubprocess`` object will be returned.
 
     """
 
     factory = MockSubprocessFactory()
+    subprocess_spawner.append(factory)
+    yield factory
+    subprocess_spawner.remove(factory)
 
-    @functools.wraps(asyncio.create_subprocess_exec)
-    def create_subprocess_exec(*args, **kwds):
-        p = MockSubprocess(args, kwds)
-        f = asyncio.Future()
-        f.set_result(p)
-        factory._instances.append(p)
-        return f
 
-    with unittest.mock.patch('asyncio.create_subprocess_exec') as spawn:
-        spawn.side_effect = create_subprocess_exec
-        yield factory
+@pytest.fixture(scope='session')
+def default_logging_settings():
+    """Default logging setup, built once, see ``logging``."""
+    return logging_settings(
+        log_format='kv',
+        utc=False,
+        endpoint='file:///dev/stdout',
+    )
 
 
 @pytest.fixture(scope='function', autouse=True)
-def logging():
+def logging(default_logging_settings):
     """Setup default logging for tests.
 
     Tests can reconfigure logging if they wish to.
     """
-    configure_logging(
-        log_format='kv',
-        utc=False,
-        endpoint='file:///dev/stdout',
-    )
+    structlog.configure(**default_logging_settings)
 
 
-async def service_fluent_client(records, reader, writer):
+async def service_fluent_client(records, received, reader, writer):
     """TCP handler for mock FluentD server.
 
+    Sets the ``received`` event once records arrive.
+
     See:
     - https://github.com/fluent/fluentd/wiki/Forward-Protocol-Specification-v0
     - https://pythonhosted.org/msgpack-python/api.html#msgpack.Unpacker
     """
-    unpacker = msgpack.Unpacker()
-    data = await reader.read(1024)
+    unpacker = msgpack.Unpacker(
+        encoding='utf-8',
+        use_list=False,
+        max_buffer_size=16 * 1024 * 1024,
+    )
+    data = await reader.read(64 * 1024)
     while data:
         unpacker.feed(data)
-        for record in unpacker:
-            records.append(record)
-        data = await reader.read(1024)
+        records.extend(unpacker)
+        if records:
+            received.set()
+        data = await reader.read(64 * 1024)
 
 
-@pytest.yield_fixture(scope='function')
-def fluent_server(event_loop, unused_tcp_port):
-    """Mock FluentD server."""
+def unused_port():
+    """Pick a TCP port that nobody is listening on."""
+    with contextlib.closing(socket.socket()) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.yield_fixture(scope='session')
+def fluent_server_session(event_loop):
+    """Mock FluentD server shared by all tests, see ``fluent_server``."""
 
     records = []
+    received = asyncio.Event(loop=event_loop)
 
     # TODO: provide a built-in means to pass in shared server state as this
     #       wrapper will probably not cancel cleanly.
     async def service_connection(reader, writer):
-        return await service_fluent_client(records, reader, writer)
+        return await service_fluent_client(
+            records, received, reader, writer,
+        )
 
     # Serve connections.
-    host, port = ('127.0.0.1', unused_tcp_port)
+    host, port = ('127.0.0.1', unused_port())
     server = aiotk.TCPServer(host, port, service_connection)
     server.start()
     event_loop.run_until_complete(server.wait_started())
-    yield host, port, records
+    yield host, port, records, received
     server.close()
     event_loop.run_until_complete(server.wait_closed())
+
+
+@pytest.fixture(scope='function')
+def fluent_server(fluent_server_session):
+    """Mock FluentD server, starting without any records."""
+    host, port, records, received = fluent_server_session
+    del records[:]
+    received.clear()
+    return host, port, records, received
@@ -2,54 +2,76 @@
 
 
 import aiohttp
-import asyncio
 import json
+import os
 import pytest
 import urllib.parse
 import uuid
-import zipfile
 
-from smartmob_agent import autoclose
+from _helpers import wait_until
+from smartmob_agent import (
+    autoclose,
+    envs_path,
+    Index,
+    Listing,
+    ProcessDetails,
+)
 from unittest import mock
 
+# Use the faster orjson codec when it's installed.
+try:
+    import orjson
+except ImportError:
+    dumps, loads = json.dumps, json.loads
+else:
+    dumps, loads = orjson.dumps, orjson.loads
 
-@asyncio.coroutine
-def get_json(client, url):
-    response = yield from client.get(url)
+
+async def get_json(client, url):
+    response = await client.get(url)
     with autoclose(response):
-        body = yield from response.read()
-        return response, json.loads(body.decode('utf-8'))
+        return response, await response.json(loads=loads)
 
 
-@asyncio.coroutine
-def post_json(client, url, payload, headers={}):
-    response = yield from client.post(
-        url, data=json.dumps(payload), headers=headers
+async def post_json(client, url, payload, headers={}):
+    response = await client.post(
+        url, data=dumps(payload), headers=headers
     )
     with autoclose(response):
-        body = yield from response.read()
-        return response, json.loads(body.decode('utf-8'))
+        return response, await response.json(loads=loads)
+
+
+async def wait_for_state(client, url, states, max_delay=0.2):
+    """Poll process details until its state is no longer in ``states``."""
+    process = None
+
+    async def settled():
+        nonlocal process
+        response, process = await get_json(client, url)
+        assert response.status == 200
+        return process['state'] not in states
+
+    await wait_until(settled, max_delay)
+    return process
 
 
 @pytest.mark.asyncio
-def test_full_flow(event_loop, server, client, file_server, event_log):
+async def test_full_flow(event_loop, server, client, file_server, event_log,
+                         canned_archives):
     """Follows links in REST API."""
 
     # Create an application.
-    archive_path = file_server.provide('stuff.zip')
-    with zipfile.ZipFile(archive_path, 'w') as archive:
-        archive.writestr('Procfile', 'web: python dots.py')
-        archive.writestr('requirements.txt', 'Flask==0.10.1')
+    file_server.provide('stuff.zip', canned_archives['web'])
 
     # Start a new session.
-    response, index = yield from get_json(
+    response, index = await get_json(
         client, server,
     )
     assert response.status == 200
     assert index['create']
 
     # Listing should be empty.
-    response, listing = yield from get_json(
+    response, listing = await get_json(
         client, index['list'],
     )
     assert response.status == 200
@@ -59,7 +81,7 @@ def test_full_flow(event_loop, server, client, file_server, event_log):
 
     # Create a new process.
     create_request_id = str(uuid.uuid4())
-    response, process = yield from post_json(
+    response, process = await post_json(
         client, index['create'], {
             'app': 'foo',
             'node': 'web.0',
@@ -83,7 +105,7 @@ def test_full_flow(event_loop, server, client, file_server, event_log):
     )])
 
     # Get the process details.
-    response, process2 = yield from get_json(
+    response, process2 = await get_json(
         client,
         process['details'],
     )
@@ -94,7 +116,7 @@ def test_full_flow(event_loop, server, client, file_server, event_log):
     # Listing should contain our new process.
     #
     # NOTE: state here is unpredictable and flaky.
-    response, listing = yield from get_json(
+    response, listing = await get_json(
         client, index['list'],
     )
     assert response.status == 200
@@ -106,7 +128,7 @@ def test_full_flow(event_loop, server, client, file_server, event_log):
     }
 
     # Attach console (to stream logs).
-    stream = yield from client.ws_connect(
+    stream = await client.ws_connect(
         process['attach']
     )
     event_log.info.assert_has_calls([mock.call(
@@ -115,10 +137,10 @@ def test_full_flow(event_loop, server, client, file_server, event_log):
     )])
 
     # Detach console.
-    yield from stream.close()
+    await stream.close()
 
     # Now, delete the process.
-    response, delete = yield from post_json(
+    response, delete = await post_json(
         client, process['delete'], {
         },
     )
@@ -141,22 +163,25 @@ def test_full_flow(event_loop, server, client, file_server, event_log):
 
 
 @pytest.mark.asyncio
-def test_create_duplicate(event_loop, server, client, file_server):
-
-    # Create an application.
-    archive_path = file_server.provide('stuff.zip')
-    with zipfile.ZipFile(archive_path, 'w') as archive:
-        archive.writestr('Procfile', 'web: python dots.py')
-        archive.writestr('requirements.txt', 'Flask==0.10.1')
+async def test_index_repeated(event_loop, server, client):
+    """Index is served from cache after the first request."""
 
-    # Start a new session.
-    response, index = yield from get_json(
-        client, server,
-    )
+    response, index1 = await get_json(client, server)
+    assert response.status == 200
+    response, index2 = await get_json(client, server)
     assert response.status == 200
+    assert index1 == index2
+
+
+@pytest.mark.asyncio
+async def test_create_duplicate(event_loop, index, client, file_server,
+                                canned_archives):
+
+    # Create an application.
+    file_server.provide('stuff.zip', canned_archives['web'])
 
     # Create a new process.
-    response, process = yield from post_json(
+    response, process = await post_json(
         client, index['create'], {
             'app': 'foo',
             'node': 'web.0',
@@ -167,8 +192,8 @@ def test_create_duplicate(event_loop, server, client, file_server):
     assert response.status == 201
 
     # Try to create the same process again.
-    response = yield from client.post(
-        index['create'], data=json.dumps({
+    response = await client.post(
+        index['create'], data=dumps({
             'app': 'foo',
             'node': 'web.0',
             'source_url': file_server.url('stuff.zip'),
@@ -179,21 +204,14 @@ def test_create_duplicate(event_loop, server, client, file_server):
         assert response.status == 409
 
     # Now, delete the process.
-    response, delete = yield from post_json(
+    response, delete = await post_json(
         client, process['delete'], {},
     )
     assert response.status == 200
 
 
 @pytest.mark.asyncio
-def test_create_missing_fields(event_loop, server, client, file_server):
-
-    # Start a new session.
-    response, index = yield from get_json(
-        client, server,
-    )
-    with autoclose(response):
-        assert response.status == 200
+async def test_create_missing_fields(event_loop, index, client, file_server):
 
     def without(d, key):
         return {k: v for k, v in d.items() if k != key}
@@ -207,55 +225,48 @@ def test_create_missing_fields(event_loop, server, client, file_server):
     }
 
     # App field is required.
-    response = yield from client.post(
-        index['create'], data=json.dumps(without(req, 'app')),
+    response = await client.post(
+        index['create'], data=dumps(without(req, 'app')),
     )
     with autoclose(response):
         assert response.status == 400
 
 
 @pytest.mark.asyncio
-def test_unknown_slug(event_loop, server, client):
+async def test_unknown_slug(event_loop, server, client):
 
     # Try to query an unknown process.
-    response = yield from client.get(
+    response = await client.get(
         urllib.parse.urljoin(server, '/process-status/unknown'),
-        data=json.dumps({}),
+        data=dumps({}),
     )
     with autoclose(response):
         assert response.status == 404
 
     # Try to delete an unknown process.
-    response = yield from client.post(
+    response = await client.post(
         urllib.parse.urljoin(server, '/delete-process/unknown'),
-        data=json.dumps({}),
+        data=dumps({}),
     )
     with autoclose(response):
         assert response.status == 404
 
     # Try to attach to an unknown process.
     with pytest.raises(aiohttp.errors.WSServerHandshakeError):
-        stream = yield from client.ws_connect(
+        stream = await client.ws_connect(
             urllib.parse.urljoin(server, '/attach-console/unknown'),
         )
         print(stream)
 
 
 @pytest.mark.asyncio
-def test_download_failure(event_loop, server, client, file_server):
+async def test_download_failure(event_loop, index, client, file_server):
     """Follows links in REST API."""
 
     # NOTE: intentionally do NOT provide an archive.
 
-    # Start a new session.
-    response, index = yield from get_json(
-        client, server,
-    )
-    assert response.status == 200
-    assert index['create']
-
     # Create a new process.
-    response, process = yield from post_json(
+    response, process = await post_json(
         client, index['create'], {
             'app': 'qux',
             'node': 'web.0',
@@ -270,20 +281,16 @@ def test_download_failure(event_loop, server, client, file_server):
     assert process['state'] == 'pending'
 
     # Wait until download completes.
-    while process['state'] in ('pending', 'downloading'):
-        yield from asyncio.sleep(0.1)
-        response, process = yield from get_json(
-            client,
-            process['details'],
-        )
-        assert response.status == 200
-        assert process['app'] == 'qux'
+    process = await wait_for_state(
+        client, process['details'], ('pending', 'downloading'),
+    )
+    assert process['app'] == 'qux'
 
     # Process should not have started.
     assert process['state'] == 'download failure'
 
     # Now, delete the process.
-    response, delete = yield from post_json(
+    response, delete = await post_json(
         client, process['delete'], {
         },
     )
@@ -292,23 +299,15 @@ def test_download_failure(event_loop, server, client, file_server):
 
 
 @pytest.mark.asyncio
-def test_no_procfile(event_loop, server, client, file_server):
+async def test_no_procfile(event_loop, index, client, file_server,
+                           canned_archives):
     """Follows links in REST API."""
 
     # Create an application without a Procfile.
-    archive_path = file_server.provide('stuff.zip')
-    with zipfile.ZipFile(archive_path, 'w') as archive:
-        archive.writestr('requirements.txt', 'Flask==0.10.1')
-
-    # Start a new session.
-    response, index = yield from get_json(
-        client, server,
-    )
-    assert response.status == 200
-    assert index['create']
+    file_server.provide('stuff.zip', canned_archives['no-procfile'])
 
     # Create a new process.
-    response, process = yield from post_json(
+    response, process = await post_json(
         client, index['create'], {
             'app': 'bar',
             'node': 'web.0',
@@ -323,20 +322,18 @@ def test_no_procfile(event_loop, server, client, file_server):
     assert process['state'] == 'pending'
 
     # Wait until download completes.
-    while process['state'] in ('pending', 'downloading', 'processing'):
-        yield from asyncio.sleep(0.1)
-        response, process = yield from get_json(
-            client,
-            process['details'],
-        )
-        assert response.status == 200
-        assert process['app'] == 'bar'
+    process = await wait_for_state(
+        client, process['details'], (
+            'pending', 'downloading', 'unpacking', 'processing',
+        ),
+    )
+    assert process['app'] == 'bar'
 
     # Process should not have started.
     assert process['state'] == 'no procfile'
 
     # Now, delete the process.
-    response, delete = yield from post_json(
+    response, delete = await post_json(
         client, process['delete'], {
         },
     )
@@ -345,24 +342,15 @@ def test_no_procfile(event_loop, server, client, file_server):
 
 
 @pytest.mark.asyncio
-def test_unknown_process_type(event_loop, server, client, file_server):
+async def test_unknown_process_type(event_loop, index, client, file_server,
+                                    canned_archives):
     """Follows links in REST API."""
 
     # Create an application.
-    archive_path = file_server.provide('stuff.zip')
-    with zipfile.ZipFile(archive_path, 'w') as archive:
-        archive.writestr('Procfile', 'web: python dots.py')
-        archive.writestr('requirements.txt', 'Flask==0.10.1')
-
-    # Start a new session.
-    response, index = yield from get_json(
-        client, server,
-    )
-    assert response.status == 200
-    assert index['create']
+    file_server.provide('stuff.zip', canned_archives['web'])
 
     # Create a new process.
-    response, process = yield from post_json(
+    response, process = await post_json(
         client, index['create'], {
             'app': 'meh',
             'node': 'web.0',
@@ -377,20 +365,18 @@ def test_unknown_process_type(event_loop, server, client, file_server):
     assert process['state'] == 'pending'
 
     # Wait until download completes.
-    while process['state'] in ('pending', 'downloading', 'processing'):
-        yield from asyncio.sleep(0.1)
-        response, process = yield from get_json(
-            client,
-            process['details'],
-        )
-        assert response.status == 200
-        assert process['app'] == 'meh'
+    process = await wait_for_state(
+        client, process['details'], (
+            'pending', 'downloading', 'unpacking', 'processing',
+        ),
+    )
+    assert process['app'] == 'meh'
 
     # Process should not have started.
     assert process['state'] == 'unknown process type'
 
     # Now, delete the process.
-    response, delete = yield from post_json(
+    response, delete = await post_json(
         client, process['delete'], {
         },
     )
@@ -399,25 +385,15 @@ def test_unknown_process_type(event_loop, server, client, file_server):
 
 
 @pytest.mark.asyncio
-def test_venv_failure(event_loop, server, client, file_server,
-                      subprocess_factory):
+async def test_venv_failure(event_loop, index, client, file_server,
+                            subprocess_factory, canned_archives):
     """Demonstrates resilience to internal failure."""
 
     # Create an application.
-    archive_path = file_server.provide('stuff.zip')
-    with zipfile.ZipFile(archive_path, 'w') as archive:
-        archive.writestr('Procfile', 'web: python dots.py')
-        archive.writestr('requirements.txt', 'Flask==0.10.1')
-
-    # Start a new session.
-    response, index = yield from get_json(
-        client, server,
-    )
-    assert response.status == 200
-    assert index['create']
+    file_server.provide('stuff.zip', canned_archives['web'])
 
     # Create a new process.
-    response, process = yield from post_json(
+    response, process = await post_json(
         client, index['create'], {
             'app': 'meh',
             'node': 'web.0',
@@ -432,36 +408,29 @@ def test_venv_failure(event_loop, server, client, file_server,
     assert process['state'] == 'pending'
 
     # Wait until download completes.
-    while process['state'] in ('pending', 'downloading'):
-        yield from asyncio.sleep(0.1)
-        response, process = yield from get_json(
-            client,
-            process['details'],
-        )
-        assert response.status == 200
-        assert process['app'] == 'meh'
+    process = await wait_for_state(
+        client, process['details'], ('pending', 'downloading'),
+    )
+    assert process['app'] == 'meh'
 
     # Wait until the virtual env process is spawned.
-    while len(subprocess_factory.instances) == 0:
-        yield from asyncio.sleep(0.1)
+    await wait_until(
+        lambda: len(subprocess_factory.instances) > 0,
+    )
 
     # Simulate failure to spawn virtual environment.
     child = subprocess_factory.last_instance
     child.mock_complete(1)
 
     # Process should not have started.
-    while process['state'] in ('processing'):
-        yield from asyncio.sleep(0.1)
-        response, process = yield from get_json(
-            client,
-            process['details'],
-        )
-        assert response.status == 200
-        assert process['app'] == 'meh'
+    process = await wait_for_state(
+        client, process['details'], ('processing',),
+    )
+    assert process['app'] == 'meh'
     assert process['state'] == 'virtual environment failure'
 
     # Now, delete the process.
-    response, delete = yield from post_json(
+    response, delete = await post_json(
         client, process['delete'], {
         },
     )
@@ -470,25 +439,15 @@ def test_venv_failure(event_loop, server, client, file_server,
 
 
 @pytest.mark.asyncio
-def test_pip_failure(event_loop, server, client, file_server,
-                     subprocess_factory):
+async def test_pip_failure(event_loop, index, client, file_server,
+                           subprocess_factory, canned_archives):
     """Demonstrates resilience to internal failure."""
 
     # Create an application.
-    archive_path = file_server.provide('stuff.zip')
-    with zipfile.ZipFile(archive_path, 'w') as archive:
-        archive.writestr('Procfile', 'web: python dots.py')
-        archive.writestr('requirements.txt', 'Flask==0.10.1')
-
-    # Start a new session.
-    response, index = yield from get_json(
-        client, server,
-    )
-    assert response.status == 200
-    assert index['create']
+    file_server.provide('stuff.zip', canned_archives['web'])
 
     # Create a new process.
-    response, process = yield from post_json(
+    response, process = await post_json(
         client, index['create'], {
             'app': 'meh',
             'node': 'web.0',
@@ -503,46 +462,226 @@ def test_pip_failure(event_loop, server, client, file_server,
     assert process['state'] == 'pending'
 
     # Wait until download completes.
-    while process['state'] in ('pending', 'downloading'):
-        yield from asyncio.sleep(0.1)
-        response, process = yield from get_json(
-            client,
-            process['details'],
-        )
-        assert response.status == 200
-        assert process['app'] == 'meh'
+    process = await wait_for_state(
+        client, process['details'], ('pending', 'downloading'),
+    )
+    assert process['app'] == 'meh'
 
     # Wait until the virtual env process is spawned.
-    while len(subprocess_factory.instances) == 0:
-        yield from asyncio.sleep(0.1)
+    await wait_until(
+        lambda: len(subprocess_factory.instances) > 0,
+    )
 
     # Let the virtual environment appear to succeed.
     child = subprocess_factory.last_instance
     child.mock_complete(0)
 
     # Wait until the pip process is spawned.
-    while len(subprocess_factory.instances) == 1:
-        yield from asyncio.sleep(0.1)
+    await wait_until(
+        lambda: len(subprocess_factory.instances) > 1,
+    )
 
     # Simulate failure to install dependencies.
     child = subprocess_factory.last_instance
     child.mock_complete(1)
 
     # Process should not have started.
-    while process['state'] in ('processing'):
-        yield from asyncio.sleep(0.1)
-        response, process = yield from get_json(
-            client,
-            process['details'],
-        )
-        assert response.status == 200
-        assert process['app'] == 'meh'
+    process = await wait_for_state(
+        client, process['details'], ('processing',),
+    )
+    assert process['app'] == 'meh'
     assert process['state'] == 'pip install failure'
 
     # Now, delete the process.
-    response, delete = yield from post_json(
+    response, delete = await post_json(
+        client, process['delete'], {
+        },
+    )
+    assert response.status == 200
+    assert delete == {}
+
+
+@pytest.mark.asyncio
+async def test_response_schemas(event_loop, server, client, file_server):
+    """Response documents match the documented schemas."""
+
+    # Start a new session.
+    response, index = await get_json(
+        client, server,
+    )
+    assert response.status == 200
+    assert Index(index) == index
+
+    # Create a new process (the download will fail, that's OK).
+    response, process = await post_json(
+        client, index['create'], {
+            'app': 'foo',
+            'node': 'web.0',
+            'source_url': file_server.url('missing.zip'),
+            'process_type': 'web',
+        },
+    )
+    assert response.status == 201
+    assert ProcessDetails(process) == process
+
+    # Query its status.
+    response, process = await get_json(
+        client, process['details'],
+    )
+    assert response.status == 200
+    assert ProcessDetails(process) == process
+
+    # List processes.
+    response, listing = await get_json(
+        client, index['list'],
+    )
+    assert response.status == 200
+    assert Listing(listing) == listing
+    assert [p['slug'] for p in listing['processes']] == [process['slug']]
+
+    # Delete the process.
+    response, delete = await post_json(
+        client, process['delete'], {
+        },
+    )
+    assert response.status == 200
+    assert delete == {}
+
+
+async def create_web_process(client, index, source_url, node='web.0'):
+    response, process = await post_json(
+        client, index['create'], {
+            'app': 'foo',
+            'node': node,
+            'source_url': source_url,
+            'process_type': 'web',
+        },
+    )
+    assert response.status == 201
+    return process
+
+
+async def delete_process(client, process):
+    response, delete = await post_json(
         client, process['delete'], {
         },
     )
     assert response.status == 200
     assert delete == {}
+
+
+def complete_venv(child):
+    """Let a mock ``virtualenv`` run succeed, creating its folder."""
+    assert child.args[1:3] == ('-m', 'virtualenv')
+    os.makedirs(child.args[-1])
+    child.mock_complete(0)
+
+
+@pytest.mark.asyncio
+async def test_shared_venv(event_loop, index, client, file_server,
+                           subprocess_factory, canned_archives):
+    """Processes with identical requirements share a virtual environment."""
+
+    file_server.provide('stuff.zip', canned_archives['web'])
+
+    # The first process builds the environment, then starts.
+    process1 = await create_web_process(
+        client, index, file_server.url('stuff.zip'), node='web.0',
+    )
+    await wait_until(lambda: len(subprocess_factory.instances) > 0)
+    complete_venv(subprocess_factory.last_instance)
+    await wait_until(lambda: len(subprocess_factory.instances) > 1)
+    assert 'install' in subprocess_factory.last_instance.args
+    subprocess_factory.last_instance.mock_complete(0)
+    await wait_until(lambda: len(subprocess_factory.instances) > 2)
+
+    # The second process starts right away, in the same environment.
+    process2 = await create_web_process(
+        client, index, file_server.url('stuff.zip'), node='web.1',
+    )
+    await wait_until(lambda: len(subprocess_factory.instances) > 3)
+    children = subprocess_factory.instances
+    assert children[3].args == children[2].args
+    assert os.path.realpath(os.path.join(envs_path, 'foo.web.1')) == \
+        os.path.realpath(os.path.join(envs_path, 'foo.web.0'))
+
+    await delete_process(client, process1)
+    await delete_process(client, process2)
+
+
+@pytest.mark.asyncio
+async def test_local_requirements(event_loop, index, client, file_server,
+                                  subprocess_factory, canned_archives):
+    """Requirements that refer to the source tree don't share environments."""
+
+    file_server.provide('stuff-1.zip', canned_archives['editable-1'])
+    file_server.provide('stuff-2.zip', canned_archives['editable-2'])
+
+    # The first process builds its environment, then starts.
+    process1 = await create_web_process(
+        client, index, file_server.url('stuff-1.zip'), node='web.0',
+    )
+    await wait_until(lambda: len(subprocess_factory.instances) > 0)
+    complete_venv(subprocess_factory.last_instance)
+    await wait_until(lambda: len(subprocess_factory.instances) > 1)
+    subprocess_factory.last_instance.mock_complete(0)
+    await wait_until(lambda: len(subprocess_factory.instances) > 2)
+
+    # The second one has identical requirements, but builds its own.
+    process2 = await create_web_process(
+        client, index, file_server.url('stuff-2.zip'), node='web.1',
+    )
+    await wait_until(lambda: len(subprocess_factory.instances) > 3)
+    complete_venv(subprocess_factory.last_instance)
+    await wait_until(lambda: len(subprocess_factory.instances) > 4)
+    assert 'install' in subprocess_factory.last_instance.args
+    subprocess_factory.last_instance.mock_complete(0)
+    await wait_until(lambda: len(subprocess_factory.instances) > 5)
+    assert os.path.realpath(os.path.join(envs_path, 'foo.web.1')) != \
+        os.path.realpath(os.path.join(envs_path, 'foo.web.0'))
+
+    await delete_process(client, process1)
+    await delete_process(client, process2)
+
+
+@pytest.mark.asyncio
+async def test_no_requirements(event_loop, index, client, file_server,
+                               subprocess_factory, canned_archives):
+    """Applications without dependencies get a bare environment."""
+
+    file_server.provide('stuff.zip', canned_archives['no-requirements'])
+    process = await create_web_process(
+        client, index, file_server.url('stuff.zip'),
+    )
+
+    # The process starts right after the environment is built, without
+    # installing anything.
+    await wait_until(lambda: len(subprocess_factory.instances) > 0)
+    complete_venv(subprocess_factory.last_instance)
+    await wait_until(lambda: len(subprocess_factory.instances) > 1)
+    assert 'install' not in subprocess_factory.last_instance.args
+
+    await delete_process(client, process)
+
+
+@pytest.mark.asyncio
+async def test_stale_venv_link(event_loop, index, client, file_server,
+                               subprocess_factory, canned_archives):
+    """Re-creating a process replaces its old environment link."""
+
+    file_server.provide('stuff.zip', canned_archives['web'])
+    link_path = os.path.join(envs_path, 'foo.web.0')
+    os.symlink('nowhere', link_path)
+
+    process = await create_web_process(
+        client, index, file_server.url('stuff.zip'),
+    )
+    await wait_until(lambda: len(subprocess_factory.instances) > 0)
+    venv = subprocess_factory.last_instance
+    complete_venv(venv)
+    await wait_until(lambda: len(subprocess_factory.instances) > 1)
+    subprocess_factory.last_instance.mock_complete(0)
+    await wait_until(lambda: len(subprocess_factory.instances) > 2)
+    assert os.path.realpath(link_path) == os.path.realpath(venv.args[-1])
+
+    await delete_process(client, process)
@@ -1,62 +1,83 @@
 # -*- coding: utf-8 -*-
 
 
-import os.path
+import pathlib
 import pytest
-import tarfile
-import zipfile
 
-from smartmob_agent import unpack_archive
+from smartmob_agent import unpack_archive, zstd_command
+from unittest import mock
 
 
-def test_unpack_archive_unknown_format(mktemp, temp_folder):
-    # Generate archive.
-    archive_path = mktemp()
-    with zipfile.ZipFile(archive_path, 'w') as archive:
-        archive.writestr('Procfile', 'python-help: python --help')
-        archive.writestr('requirements.txt', 'somelib==1.0')
-
+@pytest.mark.asyncio
+async def test_unpack_archive_unknown_format(event_loop, sample_tar,
+                                             temp_folder):
     # Cannot unpack unknown format.
     with pytest.raises(ValueError) as error:
-        unpack_archive('tgz', archive_path, temp_folder)
+        await unpack_archive('tgz', sample_tar, temp_folder)
     assert str(error.value) == 'Unknown archive format "tgz".'
 
 
-def test_unpack_archive_zip(mktemp, temp_folder):
-    # Generate archive.
-    archive_path = mktemp()
-    with zipfile.ZipFile(archive_path, 'w') as archive:
-        archive.writestr('Procfile', 'python-help: python --help')
-        archive.writestr('requirements.txt', 'somelib==1.0')
+@pytest.mark.asyncio
+async def test_unpack_archive_zip(event_loop, sample_zip, temp_folder):
+    # Unpack it.
+    await unpack_archive('zip', sample_zip, temp_folder)
+
+    # Check contents.
+    root = pathlib.Path(temp_folder)
+    assert (root / 'Procfile').read_bytes() == b'python-help: python --help'
+    assert (root / 'requirements.txt').read_bytes() == b'somelib==1.0'
+
 
+@pytest.mark.asyncio
+async def test_unpack_archive_tar(event_loop, sample_tar, temp_folder):
     # Unpack it.
-    unpack_archive('zip', archive_path, temp_folder)
+    await unpack_archive('tar', sample_tar, temp_folder)
 
     # Check contents.
-    with open(os.path.join(temp_folder, 'Procfile'), 'r') as stream:
-        assert stream.read() == 'python-help: python --help'
-    with open(os.path.join(temp_folder, 'requirements.txt'), 'r') as stream:
-        assert stream.read() == 'somelib==1.0'
+    root = pathlib.Path(temp_folder)
+    assert (root / 'Procfile').read_bytes() == b'python-help: python --help'
+    assert (root / 'requirements.txt').read_bytes() == b'somelib==1.0'
 
 
-def test_unpack_archive_tar(mktemp, temp_folder):
-    # Generate archive.
+@pytest.mark.asyncio
+async def test_unpack_archive_tar_corrupt(event_loop, mktemp, temp_folder):
+    # Generate something that isn't a tarball.
     archive_path = mktemp()
-    with tarfile.open(archive_path, 'w') as archive:
-        file_path = mktemp()
-        with open(file_path, 'w') as stream:
-            stream.write('python-help: python --help')
-        archive.add(file_path, 'Procfile')
-        file_path = mktemp()
-        with open(file_path, 'w') as stream:
-            stream.write('somelib==1.0')
-        archive.add(file_path, 'requirements.txt')
+    with open(archive_path, 'w') as stream:
+        stream.write('not a tarball')
 
-    # Unpack it.
-    unpack_archive('tar', archive_path, temp_folder)
+    # Unpacking fails.
+    with pytest.raises(Exception) as error:
+        await unpack_archive('tar', archive_path, temp_folder)
+    assert str(error.value) == 'command failed'
 
-    # Check contents.
-    with open(os.path.join(temp_folder, 'Procfile'), 'r') as stream:
-        assert stream.read() == 'python-help: python --help'
-    with open(os.path.join(temp_folder, 'requirements.txt'), 'r') as stream:
-        assert stream.read() == 'somelib==1.0'
+
+@pytest.mark.asyncio
+async def test_unpack_archive_zstd(event_loop, temp_folder):
+    commands = []
+
+    async def run_command(*command):
+        commands.append(command)
+
+    with mock.patch('smartmob_agent.run_command', run_command):
+        await unpack_archive('tar.zst', 'app.tar.zst', temp_folder)
+    assert commands == [(
+        'tar', '--use-compress-program', zstd_command(),
+        '-xf', 'app.tar.zst', '-C', temp_folder,
+    )]
+
+
+@pytest.mark.parametrize('pzstd,expected', [
+    ('/usr/bin/pzstd', 'pzstd -d'),
+    (None, 'zstd -d'),
+])
+def test_zstd_command(pzstd, expected):
+    zstd_command.cache_clear()
+    try:
+        with mock.patch('shutil.which') as which:
+            which.return_value = pzstd
+            assert zstd_command() == expected
+            assert zstd_command() == expected
+        which.assert_called_once_with('pzstd')
+    finally:
+        zstd_command.cache_clear()
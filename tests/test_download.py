@@ -7,37 +7,87 @@ from smartmob_agent import download
 
 
 @pytest.mark.asyncio
-def test_download(file_server, mktemp, client):
+async def test_download(file_server, mktemp, client):
     file_server.provide('hello.txt', 'hello, world!')
     path = mktemp()
-    content_type = yield from download(
+    content_type = await download(
         client, file_server.url('hello.txt'), path, request_id='?',
     )
     assert content_type == 'text/plain'
-    with open(path, 'r') as stream:
-        assert stream.read() == 'hello, world!'
+    with open(path, 'rb') as stream:
+        assert stream.read() == b'hello, world!'
 
 
 @pytest.mark.asyncio
-def test_download_404(file_server, mktemp, client):
+async def test_download_chunked(file_server, mktemp, client):
+    file_server.provide('hello.txt', 'hello, world!')
+    path = mktemp()
+    content_type = await download(
+        client, file_server.url('hello.txt'), path, request_id='?',
+        chunk_size=4,
+    )
+    assert content_type == 'text/plain'
+    with open(path, 'rb') as stream:
+        assert stream.read() == b'hello, world!'
+
+
+@pytest.mark.asyncio
+async def test_download_encoded(file_server, mktemp, client):
+    file_server.provide('hello.txt', 'hello, world!')
+    path = mktemp()
+    content_type = await download(
+        client, file_server.url('gzip/hello.txt'), path, request_id='?',
+    )
+    assert content_type == 'text/plain'
+    with open(path, 'rb') as stream:
+        assert stream.read() == b'hello, world!'
+
+
+@pytest.mark.asyncio
+async def test_download_404(file_server, mktemp, client):
     path = mktemp()
     with pytest.raises(Exception) as error:
-        yield from download(
+        await download(
             client, file_server.url('hello.txt'), path, request_id='?',
         )
     assert str(error.value) == 'Download failed.'
 
 
 @pytest.mark.asyncio
-def test_download_reject(file_server, mktemp, client):
+async def test_download_reject(file_server, mktemp, client):
     def check_ext(url, response):
         return not url.endswith('.zip')
 
     file_server.provide('hello.txt', 'hello, world!')
     path = mktemp()
     with pytest.raises(Exception) as error:
-        yield from download(
+        await download(
             client, file_server.url('hello.txt'), path, reject=check_ext,
             request_id='?',
         )
     assert str(error.value) == 'Download rejected.'
+
+
+@pytest.mark.asyncio
+async def test_download_too_large(file_server, mktemp, client):
+    file_server.provide('hello.txt', 'hello, world!')
+    path = mktemp()
+    with pytest.raises(Exception) as error:
+        await download(
+            client, file_server.url('hello.txt'), path, request_id='?',
+            max_size=4,
+        )
+    assert str(error.value) == 'Download too large.'
+
+
+@pytest.mark.asyncio
+async def test_download_too_large_decoded(file_server, mktemp, client):
+    # Compresses down to well under the limit, but expands way beyond it.
+    file_server.provide('zeros.bin', bytes(1024 * 1024))
+    path = mktemp()
+    with pytest.raises(Exception) as error:
+        await download(
+            client, file_server.url('gzip/zeros.bin'), path, request_id='?',
+            max_size=64 * 1024, chunk_size=4096,
+        )
+    assert str(error.value) == 'Download too large.'
@@ -1,47 +1,63 @@
 # -*- coding: utf-8 -*-
 
-import aiohttp
 import asyncio
 import json
+import msgpack
 import os
 import pytest
 import signal
 import structlog
 import testfixtures
 
+from _helpers import hello_http, when_serving
+from _mocks import EventCollector
 from contextlib import contextmanager
 from datetime import datetime
-from functools import partial
 from freezegun import freeze_time
-from itertools import chain
 from smartmob_agent import (
     configure_logging,
+    FluentBatchSender,
+    FluentLogger,
     FluentLoggerFactory,
     main,
+    responder,
+    StreamLoggerFactory,
     version,
 )
 from unittest import mock
 
 
+def unpack_fluent_events(send):
+    """Decode events written through a mock ``FluentSender._send()``."""
+    unpacker = msgpack.Unpacker(encoding='utf-8')
+    for args, _ in send.call_args_list:
+        unpacker.feed(args[0])
+    return [(tag, data) for tag, _, data in unpacker]
+
+
 @contextmanager
 def setenv(env):
-    old_env = os.environ
-    new_env = dict(chain(os.environ.items(), env.items()))
-    os.environ = new_env
+    """Temporarily set environment variables, restoring only those."""
+    old_env = {k: os.environ.get(k) for k in env}
+    os.environ.update(env)
     try:
         yield
     finally:
-        os.environ = old_env
+        for k, v in old_env.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
 
 
 def test_configure_logging_stdout(capsys):
+    configure_logging(
+        log_format='kv',
+        utc=False,
+        endpoint='file:///dev/stdout',
+    )
+    log = structlog.get_logger()
     with freeze_time("2016-05-08 21:19:00"):
-        configure_logging(
-            log_format='kv',
-            utc=False,
-            endpoint='file:///dev/stdout',
-        )
-        log = structlog.get_logger()
         log.info('teh.event', a=1)
     out, err = capsys.readouterr()
     assert err == ""
@@ -49,13 +65,13 @@ def test_configure_logging_stdout(capsys):
 
 
 def test_configure_logging_stderr(capsys):
+    configure_logging(
+        log_format='kv',
+        utc=False,
+        endpoint='file:///dev/stderr',
+    )
+    log = structlog.get_logger()
     with freeze_time("2016-05-08 21:19:00"):
-        configure_logging(
-            log_format='kv',
-            utc=False,
-            endpoint='file:///dev/stderr',
-        )
-        log = structlog.get_logger()
         log.info('teh.event', a=1)
     out, err = capsys.readouterr()
     assert out == ""
@@ -63,13 +79,13 @@ def test_configure_logging_stderr(capsys):
 
 
 def test_configure_logging_file(capsys, tempdir):
+    configure_logging(
+        log_format='kv',
+        utc=False,
+        endpoint='file://./gitmesh.log',
+    )
+    log = structlog.get_logger()
     with freeze_time("2016-05-08 21:19:00"):
-        configure_logging(
-            log_format='kv',
-            utc=False,
-            endpoint='file://./gitmesh.log',
-        )
-        log = structlog.get_logger()
         log.info('teh.event', a=1)
     out, err = capsys.readouterr()
     assert out == ""
@@ -92,22 +108,27 @@ def test_configure_logging_unknown_scheme(capsys, tempdir):
         'Invalid logging endpoint "flume://127.0.0.1:44444".'
 
 
-@pytest.mark.parametrize('log_format,expected', [
-    ('kv', "@timestamp='2016-05-08T21:19:00' event='teh.event' a=1 b=2"),
-    ('json', ('{"@timestamp": "2016-05-08T21:19:00"'
-              ', "a": 1, "b": 2, "event": "teh.event"}')),
+@pytest.mark.parametrize('log_format,decode,expected', [
+    ('kv', str.strip,
+     "@timestamp='2016-05-08T21:19:00' event='teh.event' a=1 b=2"),
+    ('json', json.loads, {
+        '@timestamp': '2016-05-08T21:19:00',
+        'a': 1,
+        'b': 2,
+        'event': 'teh.event',
+    }),
 ])
-def test_log_format(log_format, expected):
-    with freeze_time("2016-05-08 21:19:00"):
-        with testfixtures.OutputCapture() as capture:
-            configure_logging(
-                log_format=log_format,
-                utc=False,
-                endpoint='file:///dev/stderr',
-            )
-            log = structlog.get_logger()
+def test_log_format(log_format, decode, expected):
+    with testfixtures.OutputCapture() as capture:
+        configure_logging(
+            log_format=log_format,
+            utc=False,
+            endpoint='file:///dev/stderr',
+        )
+        log = structlog.get_logger()
+        with freeze_time("2016-05-08 21:19:00"):
             log.info('teh.event', a=1, b=2)
-        capture.compare(expected)
+    assert decode(capture.captured) == expected
 
 
 @pytest.mark.parametrize('url,host,port,app', [
@@ -138,8 +159,8 @@ def test_fluent_url_parser_invalid_url(url):
     ('fluent://127.0.0.1:24224/the-app', True, '2016-05-08T21:19:00+00:00'),
     ('fluent://127.0.0.1:24224/the-app', False, '2016-05-08T21:19:00'),
 ])
-@mock.patch('fluent.sender.FluentSender.emit')
-def test_logging_fluentd(emit, logging_endpoint, utc, expected_timestamp):
+@mock.patch('fluent.sender.FluentSender._send')
+def test_logging_fluentd(send, logging_endpoint, utc, expected_timestamp):
     with freeze_time("2016-05-08 21:19:00"):
         configure_logging(
             log_format='kv',  # Ignored!
@@ -150,11 +171,142 @@ def test_logging_fluentd(emit, logging_endpoint, utc, expected_timestamp):
         with testfixtures.OutputCapture() as capture:
             log.info('teh.event', a=1, b=2)
         capture.compare('')
-        emit.assert_called_once_with('teh.event', {
+        send.assert_called_once_with(mock.ANY)
+        assert unpack_fluent_events(send) == [('the-app.teh.event', {
             'a': 1,
             'b': 2,
             '@timestamp': expected_timestamp,
-        })
+        })]
+
+
+@pytest.mark.asyncio
+async def test_fluent_batch_sender(event_loop):
+    sender = mock.MagicMock()
+    sender._make_packet.side_effect = lambda label, *_: label.encode('utf-8')
+    batch = FluentBatchSender(sender, batch_size=3, flush_interval=0.1)
+
+    # Events are buffered while the event loop is running.
+    batch.emit('a', {})
+    batch.emit('b', {})
+    assert sender._send.call_count == 0
+
+    # They're sent together once the flush interval elapses.
+    await asyncio.sleep(0.2)
+    sender._send.assert_called_once_with(b'ab')
+    sender._send.reset_mock()
+
+    # Or as soon as the batch is full.
+    batch.emit('c', {})
+    batch.emit('d', {})
+    batch.emit('e', {})
+    sender._send.assert_called_once_with(b'cde')
+    sender._send.reset_mock()
+
+    # Nothing is sent when there are no pending events.
+    batch.flush()
+    assert sender._send.call_count == 0
+
+
+def test_fluent_batch_sender_send_failure(event_loop):
+    sender = mock.MagicMock()
+    sender._make_packet.side_effect = lambda label, *_: label.encode('utf-8')
+    sender._send.side_effect = [OSError(), None]
+    batch = FluentBatchSender(sender)
+
+    # A failed send drops the batch instead of retrying it forever.
+    with pytest.raises(OSError):
+        batch.emit('a', {})
+    batch.emit('b', {})
+    assert sender._send.call_args_list == [mock.call(b'a'), mock.call(b'b')]
+
+
+@pytest.mark.parametrize('level', [
+    'debug', 'info', 'warning', 'error', 'critical', 'exception',
+])
+def test_fluent_logger_levels(level):
+    sender = mock.MagicMock()
+    getattr(FluentLogger(sender), level)('teh.event', a=1)
+    sender.emit.assert_called_once_with('teh.event', {'a': 1})
+
+
+@mock.patch('fluent.sender.FluentSender._send')
+def test_logging_fluentd_unserializable(send):
+    configure_logging(
+        log_format='kv',  # Ignored!
+        utc=False,
+        endpoint='fluent://127.0.0.1:24224/the-app',
+    )
+    log = structlog.get_logger()
+    log.info('teh.event', a=object())
+    log.info('teh.event', a=1)
+
+    # The bad event is replaced, like ``FluentSender.emit()`` does, and
+    # doesn't get in the way of later events.
+    (tag1, data1), (tag2, data2) = unpack_fluent_events(send)
+    assert (tag1, data1) == ('the-app.teh.event', {
+        'level': 'CRITICAL',
+        'message': "Can't output to log",
+        'traceback': mock.ANY,
+    })
+    assert tag2 == 'the-app.teh.event'
+    assert data2['a'] == 1
+
+
+def test_responder_flushes_logs(event_loop, tempdir):
+    configure_logging(
+        log_format='kv',
+        utc=False,
+        endpoint='file://./agent.log',
+    )
+    log = structlog.get_logger()
+
+    async def log_event():
+        log.info('teh.event', a=1)
+
+    # Events logged while the loop runs are written out on shutdown.
+    with responder(event_loop, port=0):
+        event_loop.run_until_complete(log_event())
+    with open('./agent.log', 'r') as stream:
+        logs = stream.read()
+    assert "event='teh.event' a=1" in logs
+
+
+@pytest.mark.asyncio
+async def test_stream_logger_batches_flushes(event_loop):
+    stream = mock.MagicMock()
+    factory = StreamLoggerFactory(stream, batch_size=3, flush_interval=0.1)
+
+    # Events are buffered while the event loop is running.
+    factory().info('a')
+    factory().info('b')
+    assert stream.write.call_count == 0
+
+    # They're written together once the flush interval elapses.
+    await asyncio.sleep(0.2)
+    stream.write.assert_called_once_with('a\nb\n')
+    stream.flush.assert_called_once_with()
+
+
+def test_stream_logger_write_failure(event_loop):
+    stream = mock.MagicMock()
+    stream.write.side_effect = [OSError(), None]
+    factory = StreamLoggerFactory(stream)
+
+    # A failed write drops the batch instead of retrying it forever.
+    with pytest.raises(OSError):
+        factory().info('a')
+    factory().info('b')
+    assert stream.write.call_args_list == [mock.call('a\n'), mock.call('b\n')]
+
+
+@pytest.mark.parametrize('level', [
+    'debug', 'info', 'warning', 'error', 'critical', 'exception',
+])
+def test_stream_logger_levels(event_loop, level):
+    stream = mock.MagicMock()
+    factory = StreamLoggerFactory(stream)
+    getattr(factory(), level)('a')
+    stream.write.assert_called_once_with('a\n')
 
 
 @mock.patch('sys.argv', ['smartmob-agent', '--version'])
@@ -174,39 +326,18 @@ def test_main_explicit_args(capsys):
     assert stdout.strip() == version
 
 
-def test_main_ctrl_c(capsys, event_loop):
-
-    # ...
-    @asyncio.coroutine
-    def fetch_http(url):
-        client = aiohttp.ClientSession(loop=event_loop)
-        response = yield from client.get(url)
-        assert response.status == 200
-        body = yield from response.read()
-        body = body.strip()
-        client.close()
-        return body
-
-    def forward(target, source):
-        try:
-            target.set_result(source.result())
-        except Exception as error:
-            target.set_exception(error)
-
-    def hello_http(f):
-        t = event_loop.create_task(fetch_http('http://127.0.0.1:8080'))
-        t.add_done_callback(partial(forward, f))
+def test_main_ctrl_c(capsys, event_loop, client):
 
-    # Automatically trigger CTRL-C after the test queries have run.
+    # Query the agent once it's up, then trigger CTRL-C.
     f = asyncio.Future()
-    event_loop.call_later(0.5, hello_http, f)
-    event_loop.call_later(0.6, os.kill, os.getpid(), signal.SIGINT)
+    f.add_done_callback(lambda _: os.kill(os.getpid(), signal.SIGINT))
+    serving = when_serving(event_loop, hello_http, event_loop, client, f)
 
     # Run the main function.
-    event_log = mock.MagicMock()
-    with mock.patch('structlog.get_logger') as get_logger:
+    event_log = EventCollector()
+    with mock.patch('structlog.get_logger') as get_logger, serving:
         get_logger.return_value = event_log
-        main([])
+        main(['--port=0'])
 
     # Error log should be empty.
     stdout, stderr = capsys.readouterr()
@@ -214,118 +345,65 @@ def test_main_ctrl_c(capsys, event_loop):
     assert stdout.strip() == ''
 
     # Structured event log should show the CTRL-C request.
-    event_log.info.assert_has_calls([
-        mock.call('bind', transport='tcp', host='0.0.0.0', port=8080),
-        mock.call(
-            'http.access', path='/', outcome=200,
-            duration=mock.ANY, request=mock.ANY,
-            **{'@timestamp': mock.ANY}
-        ),
-        mock.call('stop', reason='ctrl-c'),
-    ])
-
-    # Body should match!
-    assert json.loads(f.result().decode('utf-8'))
-
-
-def test_main_fluent_logging_endpoint(capsys, event_loop, fluent_server):
-
-    async def fetch_http(url):
-        async with aiohttp.ClientSession(loop=event_loop) as client:
-            async with client.get(url) as response:
-                assert response.status == 200
-                body = await response.read()
-                body = body.strip()
-        return body
-
-    def forward(target, source):
-        try:
-            target.set_result(source.result())
-        except Exception as error:
-            target.set_exception(error)
-
-    def hello_http(f):
-        t = event_loop.create_task(fetch_http('http://127.0.0.1:8080'))
-        t.add_done_callback(partial(forward, f))
-
-    # Automatically trigger CTRL-C after the test queries have run.
-    f = asyncio.Future()
-    event_loop.call_later(0.5, hello_http, f)
-    event_loop.call_later(0.6, os.kill, os.getpid(), signal.SIGINT)
-
-    # Run the main function.
-    main([
-        '--logging-endpoint=fluent://%s:%d/smartmob-agent' % (
-            fluent_server[0],
-            fluent_server[1],
-        ),
-    ])
-
-    # Error log should be empty.
-    stdout, stderr = capsys.readouterr()
-    assert stderr.strip() == ''
-    assert stdout.strip() == ''
-
-    # Git hook logs will be sent to our mock FluentD server.
-    assert len(fluent_server[2]) > 0
+    assert [event for event, _ in event_log.events] == [
+        'bind', 'http.access', 'stop',
+    ]
+    bind, access, stop = [fields for _, fields in event_log.events]
+    assert bind['transport'] == 'tcp'
+    assert bind['host'] == '0.0.0.0'
+    assert bind['port'] > 0  # picked by the OS.
+    assert access['path'] == '/'
+    assert access['outcome'] == 200
+    assert stop == {'reason': 'ctrl-c'}
 
     # Body should match!
-    assert json.loads(f.result().decode('utf-8'))
-
+    assert f.result().startswith(b'{')
 
-def test_main_fluent_logging_endpoint_env(capsys, event_loop, fluent_server):
 
-    async def fetch_http(url):
-        async with aiohttp.ClientSession(loop=event_loop) as client:
-            async with client.get(url) as response:
-                assert response.status == 200
-                body = await response.read()
-                body = body.strip()
-        return body
+@pytest.mark.parametrize('from_env', [False, True])
+def test_main_fluent_logging_endpoint(capsys, event_loop, client,
+                                      fluent_server, from_env):
 
-    def forward(target, source):
-        try:
-            target.set_result(source.result())
-        except Exception as error:
-            target.set_exception(error)
-
-    def hello_http(f):
-        t = event_loop.create_task(fetch_http('http://127.0.0.1:8080'))
-        t.add_done_callback(partial(forward, f))
-
-    # Automatically trigger CTRL-C after the test queries have run.
+    # Query the agent once it's up, then stop it.
+    stop = asyncio.Event()
     f = asyncio.Future()
-    event_loop.call_later(0.5, hello_http, f)
-    event_loop.call_later(0.6, os.kill, os.getpid(), signal.SIGINT)
-
-    # Run the main function.
-    env = {
-        'SMARTMOB_LOGGING_ENDPOINT': 'fluent://%s:%d/smartmob-agent' % (
-            fluent_server[0],
-            fluent_server[1],
-        ),
-    }
-    with setenv(env):
-        main([])
+    f.add_done_callback(lambda _: stop.set())
+    serving = when_serving(event_loop, hello_http, event_loop, client, f)
+
+    # Run the main function, passing the endpoint either way.
+    endpoint = 'fluent://%s:%d/smartmob-agent' % (
+        fluent_server[0],
+        fluent_server[1],
+    )
+    with serving:
+        if from_env:
+            with setenv({'SMARTMOB_LOGGING_ENDPOINT': endpoint}):
+                main(['--port=0'], stop=stop)
+        else:
+            main(['--port=0', '--logging-endpoint=%s' % endpoint], stop=stop)
 
     # Error log should be empty.
     stdout, stderr = capsys.readouterr()
     assert stderr.strip() == ''
     assert stdout.strip() == ''
 
-    # Git hook logs will be sent to our mock FluentD server.
+    # Git hook logs will be sent to our mock FluentD server (it only reads
+    # them while the event loop runs).
+    event_loop.run_until_complete(asyncio.wait_for(
+        fluent_server[3].wait(), timeout=5.0,
+    ))
     assert len(fluent_server[2]) > 0
 
     # Body should match!
-    assert json.loads(f.result().decode('utf-8'))
+    assert f.result().startswith(b'{')
 
 
 @pytest.mark.parametrize('timestamp,expected_timestamp', [
     ('2016-05-08T21:19:00', '2016-05-08T21:19:00'),
     (datetime(2016, 5, 8, 21, 19, 0), '2016-05-08T21:19:00'),
 ])
-@mock.patch('fluent.sender.FluentSender.emit')
-def test_logging_fluentd_override_timestamp(emit, timestamp,
+@mock.patch('fluent.sender.FluentSender._send')
+def test_logging_fluentd_override_timestamp(send, timestamp,
                                             expected_timestamp):
     with freeze_time("2016-05-08 21:19:00"):
         configure_logging(
@@ -337,8 +415,9 @@ def test_logging_fluentd_override_timestamp(emit, timestamp,
         with testfixtures.OutputCapture() as capture:
             log.info('teh.event', a=1, b=2, **{'@timestamp': timestamp})
         capture.compare('')
-        emit.assert_called_once_with('teh.event', {
+        send.assert_called_once_with(mock.ANY)
+        assert unpack_fluent_events(send) == [('the-app.teh.event', {
             'a': 1,
             'b': 2,
             '@timestamp': expected_timestamp,
-        })
+        })]
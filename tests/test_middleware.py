@@ -4,11 +4,12 @@
 import asyncio
 import aiohttp
 import aiohttp.web
+import contextlib
 import logging
 import pytest
-import testfixtures
 
 from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
 from smartmob_agent import (
     access_log_middleware,
     echo_request_id,
@@ -17,6 +18,46 @@ from smartmob_agent import (
 from unittest import mock
 
 
+@contextlib.contextmanager
+def capture_logs(level):
+    """Collect log records of at least ``level`` that reach the root logger."""
+    records = []
+    handler = logging.Handler(level)
+    handler.emit = records.append
+    root = logging.getLogger()
+    root.addHandler(handler)
+    try:
+        yield records
+    finally:
+        root.removeHandler(handler)
+
+
+def make_clock(*ticks):
+    """Clock that returns ``ticks`` in order, one per call."""
+    ticks = iter(ticks)
+    return lambda: next(ticks)
+
+
+async def handle_directly(event_log, index, headers=None):
+    """Run a request through our middleware stack, without any server.
+
+    Applies the middlewares and the ``echo_request_id`` signal like aiohttp
+    does, which is enough for tests that don't depend on aiohttp's own error
+    handling.
+    """
+    app = {
+        'smartmob.event_log': event_log,
+        'smartmob.clock': make_clock(0.0, 1.0),
+    }
+    handler = index
+    for factory in (access_log_middleware, inject_request_id):
+        handler = await factory(app, handler)
+    request = make_mocked_request('GET', '/', headers=headers)
+    response = await handler(request)
+    await echo_request_id(request, response)
+    return response
+
+
 class HTTPServer:
     """Run an aiohttp application as an asynchronous context manager."""
 
@@ -34,21 +75,31 @@ class HTTPServer:
             self._handler, self._host, self._port,
         )
 
+    @property
+    def port(self):
+        """Port the server listens on (useful when binding port 0)."""
+        return self._server.sockets[0].getsockname()[1]
+
     async def __aexit__(self, *args):
         assert self._server
         self._server.close()
         await self._server.wait_closed()
         await self._app.shutdown()
-        await self._handler.finish_connections(1.0)
+        # NOTE: tests read or release their responses in full, so the only
+        #       lingering connections are idle keep-alives from the shared
+        #       client.
+        await self._handler.finish_connections(0.0)
         await self._app.cleanup()
         self._server = None
 
 
-@pytest.mark.asyncio
-async def test_access_log_success_200(event_loop, unused_tcp_port):
-    event_log = mock.MagicMock()
-    clock = mock.MagicMock()
-    clock.side_effect = [0.0, 1.0]
+@pytest.yield_fixture(scope='module')
+def middleware_server(event_loop):
+    """Application with our middleware stack, served once for the module.
+
+    Tests plug in their own ``test.index`` handler, event log and clock, and
+    get the application and its URL.
+    """
 
     app = aiohttp.web.Application(
         loop=event_loop,
@@ -58,26 +109,44 @@ async def test_access_log_success_200(event_loop, unused_tcp_port):
         ],
     )
     app.on_response_prepare.append(echo_request_id)
-    app['smartmob.event_log'] = event_log
-    app['smartmob.clock'] = clock
 
     async def index(request):
-        return aiohttp.web.Response(body=b'...')
+        return await request.app['test.index'](request)
 
     app.router.add_route('GET', '/', index)
 
-    # Given the server is running.
-    async with HTTPServer(app, '127.0.0.1', unused_tcp_port):
+    server = HTTPServer(app, '127.0.0.1', 0)
+    event_loop.run_until_complete(server.__aenter__())
+    yield app, 'http://127.0.0.1:%d' % (server.port,)
+    event_loop.run_until_complete(server.__aexit__(None, None, None))
 
-        # When I access the index.
-        index_url = 'http://127.0.0.1:%d' % (unused_tcp_port,)
-        async with aiohttp.ClientSession(loop=event_loop) as client:
-            async with client.get(index_url) as rep:
-                assert rep.status == 200
-                request_id = rep.headers['x-request-id']
-                assert request_id
-                body = await rep.read()
-                assert body == b'...'
+
+@pytest.fixture
+def access_log(middleware_server):
+    """Fresh event log and clock plugged into the shared middleware server.
+
+    Returns the application, its URL and the event log.
+    """
+    app, url = middleware_server
+    event_log = mock.MagicMock()
+    app['smartmob.event_log'] = event_log
+    app['smartmob.clock'] = make_clock(0.0, 1.0)
+    return app, url, event_log
+
+
+@pytest.mark.asyncio
+async def test_access_log_success_200(event_loop):
+    event_log = mock.MagicMock()
+
+    async def index(request):
+        return aiohttp.web.Response(body=b'...')
+
+    # When I access the index.
+    rep = await handle_directly(event_log, index)
+    assert rep.status == 200
+    request_id = rep.headers['x-request-id']
+    assert request_id
+    assert rep.body == b'...'
 
     # Then the request is logged in the access log.
     event_log.info.assert_called_once_with(
@@ -96,39 +165,18 @@ async def test_access_log_success_200(event_loop, unused_tcp_port):
     302,
 ])
 @pytest.mark.asyncio
-async def test_access_log_success_other(status, event_loop, unused_tcp_port):
+async def test_access_log_success_other(status, event_loop):
     event_log = mock.MagicMock()
-    clock = mock.MagicMock()
-    clock.side_effect = [0.0, 1.0]
-
-    app = aiohttp.web.Application(
-        loop=event_loop,
-        middlewares=[
-            inject_request_id,
-            access_log_middleware,
-        ],
-    )
-    app.on_response_prepare.append(echo_request_id)
-    app['smartmob.event_log'] = event_log
-    app['smartmob.clock'] = clock
 
     async def index(request):
         return aiohttp.web.Response(status=status, body=b'')
 
-    app.router.add_route('GET', '/', index)
-
-    # Given the server is running.
-    async with HTTPServer(app, '127.0.0.1', unused_tcp_port):
-
-        # When I access the index.
-        index_url = 'http://127.0.0.1:%d' % (unused_tcp_port,)
-        async with aiohttp.ClientSession(loop=event_loop) as client:
-            async with client.get(index_url, allow_redirects=False) as rep:
-                assert rep.status == status
-                request_id = rep.headers['x-request-id']
-                assert request_id
-                body = await rep.read()
-                assert body == b''
+    # When I access the index.
+    rep = await handle_directly(event_log, index)
+    assert rep.status == status
+    request_id = rep.headers['x-request-id']
+    assert request_id
+    assert rep.body == b''
 
     # Then the request is logged in the access log.
     event_log.info.assert_called_once_with(
@@ -148,39 +196,22 @@ async def test_access_log_success_other(status, event_loop, unused_tcp_port):
 ])
 @pytest.mark.asyncio
 async def test_access_log_failure_http_exception(exc_class, expected_status,
-                                                 event_loop, unused_tcp_port):
-    event_log = mock.MagicMock()
-    clock = mock.MagicMock()
-    clock.side_effect = [0.0, 1.0]
-
-    app = aiohttp.web.Application(
-        loop=event_loop,
-        middlewares=[
-            inject_request_id,
-            access_log_middleware,
-        ],
-    )
-    app.on_response_prepare.append(echo_request_id)
-    app['smartmob.event_log'] = event_log
-    app['smartmob.clock'] = clock
-
+                                                 event_loop, client,
+                                                 access_log):
     async def index(request):
         raise exc_class(body=b'...')
 
-    app.router.add_route('GET', '/', index)
-
     # Given the server is running.
-    async with HTTPServer(app, '127.0.0.1', unused_tcp_port):
+    app, index_url, event_log = access_log
+    app['test.index'] = index
 
-        # When I access the index.
-        index_url = 'http://127.0.0.1:%d' % (unused_tcp_port,)
-        async with aiohttp.ClientSession(loop=event_loop) as client:
-            async with client.get(index_url) as rep:
-                assert rep.status == expected_status
-                request_id = rep.headers['x-request-id']
-                assert request_id
-                body = await rep.read()
-                assert body == b'...'
+    # When I access the index.
+    async with client.get(index_url) as rep:
+        assert rep.status == expected_status
+        request_id = rep.headers['x-request-id']
+        assert request_id
+        body = await rep.read()
+        assert body == b'...'
 
     # Then the request is logged in the access log.
     event_log.info.assert_called_once_with(
@@ -200,41 +231,25 @@ async def test_access_log_failure_http_exception(exc_class, expected_status,
 ])
 @pytest.mark.asyncio
 async def test_access_log_failure_other_exception(exc_class, event_loop,
-                                                  unused_tcp_port):
-    event_log = mock.MagicMock()
-    clock = mock.MagicMock()
-    clock.side_effect = [0.0, 1.0]
-
-    app = aiohttp.web.Application(
-        loop=event_loop,
-        middlewares=[
-            inject_request_id,
-            access_log_middleware,
-        ],
-    )
-    app.on_response_prepare.append(echo_request_id)
-    app['smartmob.event_log'] = event_log
-    app['smartmob.clock'] = clock
-
+                                                  client, access_log):
     async def index(request):
         raise exc_class()
 
-    app.router.add_route('GET', '/', index)
-
     # Given the server is running.
-    async with HTTPServer(app, '127.0.0.1', unused_tcp_port):
-
-        # When I access the index.
-        with testfixtures.LogCapture(level=logging.WARNING) as capture:
-            index_url = 'http://127.0.0.1:%d' % (unused_tcp_port,)
-            async with aiohttp.ClientSession(loop=event_loop) as client:
-                async with client.get(index_url) as rep:
-                    assert rep.status == 500
-                    # request_id = rep.headers['x-request-id']
-                    # assert request_id
-                    body = await rep.read()
-                    assert body  # HTML content.
-        capture.check(('aiohttp.web', 'ERROR', mock.ANY))
+    app, index_url, event_log = access_log
+    app['test.index'] = index
+
+    # When I access the index.
+    with capture_logs(logging.WARNING) as records:
+        async with client.get(index_url) as rep:
+            assert rep.status == 500
+            # request_id = rep.headers['x-request-id']
+            # assert request_id
+            body = await rep.read()
+            assert body  # HTML content.
+    assert [(r.name, r.levelname) for r in records] == [
+        ('aiohttp.web', 'ERROR'),
+    ]
 
     # Then the request is logged in the access log.
     event_log.info.assert_called_once_with(
@@ -248,43 +263,22 @@ async def test_access_log_failure_other_exception(exc_class, event_loop,
 
 
 @pytest.mark.asyncio
-async def test_access_log_custom_request_id(event_loop, unused_tcp_port):
+async def test_access_log_custom_request_id(event_loop):
     event_log = mock.MagicMock()
-    clock = mock.MagicMock()
-    clock.side_effect = [0.0, 1.0]
 
     request_id = 'My very own request ID!'
 
-    app = aiohttp.web.Application(
-        loop=event_loop,
-        middlewares=[
-            inject_request_id,
-            access_log_middleware,
-        ],
-    )
-    app.on_response_prepare.append(echo_request_id)
-    app['smartmob.event_log'] = event_log
-    app['smartmob.clock'] = clock
-
     async def index(request):
         return aiohttp.web.Response(body=b'...')
 
-    app.router.add_route('GET', '/', index)
-
-    # Given the server is running.
-    async with HTTPServer(app, '127.0.0.1', unused_tcp_port):
-
-        # When I access the index.
-        index_url = 'http://127.0.0.1:%d' % (unused_tcp_port,)
-        async with aiohttp.ClientSession(loop=event_loop) as client:
-            head = {
-                'X-Request-Id': request_id
-            }
-            async with client.get(index_url, headers=head) as rep:
-                assert rep.status == 200
-                assert rep.headers['x-request-id'] == request_id
-                body = await rep.read()
-                assert body == b'...'
+    # When I access the index.
+    head = {
+        'X-Request-Id': request_id
+    }
+    rep = await handle_directly(event_log, index, headers=head)
+    assert rep.status == 200
+    assert rep.headers['x-request-id'] == request_id
+    assert rep.body == b'...'
 
     # Then the request is logged in the access log.
     event_log.info.assert_called_once_with(
@@ -298,11 +292,10 @@ async def test_access_log_custom_request_id(event_loop, unused_tcp_port):
 
 
 @pytest.mark.asyncio
-async def test_access_log_no_signal(event_loop, unused_tcp_port):
+async def test_access_log_no_signal(event_loop, client):
     """Middleware doesn't cause side-effects when misused."""
     event_log = mock.MagicMock()
-    clock = mock.MagicMock()
-    clock.side_effect = [0.0, 1.0]
+    clock = make_clock(0.0, 1.0)
 
     app = aiohttp.web.Application(
         loop=event_loop,
@@ -322,16 +315,15 @@ async def test_access_log_no_signal(event_loop, unused_tcp_port):
     app.router.add_route('GET', '/', index)
 
     # Given the server is running.
-    async with HTTPServer(app, '127.0.0.1', unused_tcp_port):
+    server = HTTPServer(app, '127.0.0.1', 0)
+    async with server:
 
         # When I access the index.
-        index_url = 'http://127.0.0.1:%d' % (unused_tcp_port,)
-        async with aiohttp.ClientSession(loop=event_loop) as client:
-            async with client.get(index_url) as rep:
-                assert rep.status == 200
-                assert 'x-request-id' not in rep.headers
-                body = await rep.read()
-                assert body == b'...'
+        index_url = 'http://127.0.0.1:%d' % (server.port,)
+        async with client.get(index_url) as rep:
+            assert rep.status == 200
+            assert 'x-request-id' not in rep.headers
+            await rep.release()
 
     # Then the request is logged in the access log.
     event_log.info.assert_called_once_with(
@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
 
 
-from smartmob_agent import responder
+import collections
+import json
+
+from smartmob_agent import index_renderer, load_procfile, responder
+from unittest import mock
 
 
 def test_app_reboot(event_loop):
@@ -9,3 +13,46 @@ def test_app_reboot(event_loop):
         pass
     with responder(event_loop):
         pass
+
+
+def test_index_renderer_cache():
+    routes = {
+        'list-processes': mock.MagicMock(),
+        'create-process': mock.MagicMock(),
+    }
+    routes['list-processes'].url.return_value = '/list-processes'
+    routes['create-process'].url.return_value = '/create-process'
+    render = index_renderer(routes, maxsize=2)
+
+    # Bodies are computed once per URL prefix.
+    body = render('http://a')
+    assert json.loads(body.decode('utf-8')) == {
+        'list': 'http://a/list-processes',
+        'create': 'http://a/create-process',
+    }
+    assert render('http://a') is body
+    assert routes['list-processes'].url.call_count == 1
+
+    # Old entries are evicted when other prefixes show up.
+    render('http://b')
+    render('http://c')
+    assert render.cache_info().currsize == 2
+
+
+def test_load_procfile_cache(tempdir):
+    with open('Procfile', 'w') as stream:
+        stream.write('web: python app.py')
+    cache = collections.OrderedDict()
+
+    # Parsed Procfiles are reused for identical archives.
+    process_types = load_procfile(cache, 'a', 'Procfile', maxsize=2)
+    assert process_types['web']['cmd']
+    with mock.patch('procfile.loadfile') as loadfile:
+        assert load_procfile(cache, 'a', 'Procfile') is process_types
+    assert loadfile.call_count == 0
+
+    # Least recently used entries are evicted.
+    load_procfile(cache, 'b', 'Procfile', maxsize=2)
+    load_procfile(cache, 'a', 'Procfile', maxsize=2)
+    load_procfile(cache, 'c', 'Procfile', maxsize=2)
+    assert list(cache) == ['a', 'c']